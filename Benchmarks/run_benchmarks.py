@@ -0,0 +1,233 @@
+import os, sys
+import json
+import shutil
+import argparse
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+import synthetic
+
+#Times each pipeline stage on synthetic data at several sizes and compares against stored baselines. Every stage runs
+#as its own process in a per-size work directory (so Output/ caches stay there); wall time comes from the clock and
+#peak RSS from that process's rusage, or its run report's peak if higher. Per-phase times, peaks, row and failure
+#counts come from the stage's run report (Utilities/instrumentation.py). Each output is summarized (rows and numeric column sums) so a change that alters
+#results shows up next to one that only alters speed. Runs fully offline: inputs come from synthetic.py.
+#
+#    python Benchmarks/run_benchmarks.py --sizes 1000 10000 100000
+#    python Benchmarks/run_benchmarks.py --sizes 1000 10000 --update_baseline
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+stages = ['block_vote', 'gmetric_per_block', 'gmetric_tiled', 'gmetric_sweep', 'gmetric_per_zcta', 'zcta_sweep', 'zcta_crosswalk', 'simulate_segregation']
+
+#Stages whose output must match another stage's output block by block (to within --match_tolerance)
+references = { 'gmetric_tiled' : 'gmetrics.shp' }
+
+#Derived caches cleared before each stage unless --warm
+caches = ['geometry_cache', 'block_weights', 'adjacency']
+
+def commands(radius):
+
+    #(script, arguments, output) per stage, run from the size's work directory
+    return {
+        'block_vote' : ('GerrymanderingMetrics/2_calculate_block_vote.py', ['-v', 'vr.csv', '-p', 'precincts.shp', '-b', 'blocks.shp', '-d', 'demo.csv', '-i', '-o', 'block_vote.shp'], 'block_vote.shp'),
+        'gmetric_per_block' : ('GerrymanderingMetrics/3_gmetric_per_block.py', ['-b', 'block_vote.shp', '-d', 'districts.shp', '--udm', '--opd', '-r', str(radius), '-o', 'gmetrics.shp'], 'gmetrics.shp'),
+        'gmetric_tiled' : ('GerrymanderingMetrics/3_gmetric_per_block.py', ['-b', 'block_vote.shp', '-d', 'districts.shp', '--udm', '--opd', '-r', str(radius), '-n', '2', '--tile_size', '1000', '-o', 'gmetrics_tiled.shp'], 'gmetrics_tiled.shp'),
+        'gmetric_sweep' : ('GerrymanderingMetrics/3_gmetric_per_block.py', ['-b', 'block_vote.shp', '-d', 'districts.shp', '--udm', '-r', str(radius // 2), str(radius), '-o', 'gmetrics_sweep.shp'], 'gmetrics_sweep.shp'),
+        'gmetric_per_zcta' : ('GerrymanderingMetrics/4_gmetric_per_zcta.py', ['-g', 'gmetrics.shp', '-z', 'zctas.shp', '-i', 'GISJOIN', '-o', 'zcta_metrics.shp'], 'zcta_metrics.shp'),
+        'zcta_sweep' : ('GerrymanderingMetrics/4_gmetric_per_zcta.py', ['-g', 'gmetrics_sweep.shp', '-z', 'zctas.shp', '-i', 'GISJOIN', '-o', 'zcta_sweep.shp'], 'zcta_sweep.shp'),
+        'zcta_crosswalk' : ('Utilities/zcta_crosswalk.py', ['-z', 'zctas.shp', '-r', 'reference.shp', '-b', 'blocks.shp', '-d', 'demo.csv', '-s', 'state.shp', '-o', 'crosswalk.csv'], os.path.join('Output', 'zcta_crosswalk', 'crosswalk.csv')),
+        'simulate_segregation' : ('Segregation/simulate_segregation.py', ['districts.shp', '--blocks', 'block_vote.shp', '-t', '0', '0.1', '-i', '2', '--voters_per_district', '200', '-o', 'simulation.csv'], 'simulation.csv'),
+    }
+
+
+def run(argv, cwd, log, report):
+
+    #Wall seconds, peak RSS (MB) and exit code of one child process, which writes its run report to report
+    if os.path.exists(report):
+        os.remove(report)
+
+    with open(log, 'w') as f:
+        start = time.perf_counter()
+        process = subprocess.Popen(argv, cwd = cwd, stdout = f, stderr = subprocess.STDOUT, env = dict(os.environ, RUN_REPORT = report))
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    #ru_maxrss is in KB on Linux and bytes on macOS
+    rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    return seconds, rss, process.returncode
+
+
+def phases(report):
+
+    #{ phase : { seconds, peak_rss_mb, rows } }, failure counts and the process peak RSS from a stage's run report
+    if not os.path.exists(report):
+        return {}, {}, None
+
+    with open(report) as f:
+        run = json.load(f)
+
+    return { p['name'] : { 'seconds' : p['seconds'], 'peak_rss_mb' : p['peak_rss_mb'], 'rows' : p['rows'] } for p in run['phases'] }, run['failures'], run.get('peak_rss_mb')
+
+
+def summarize(path):
+
+    if not os.path.exists(path):
+        return None
+
+    table = pd.read_csv(path) if path.endswith('.csv') else pd.DataFrame(gpd.read_file(path).drop(columns = 'geometry'))
+    numeric = table.select_dtypes(include = 'number')
+
+    return { 'rows' : int(table.shape[0]), 'sums' : { c : float(np.nansum(numeric[c].to_numpy(dtype = float))) for c in sorted(numeric.columns) } }
+
+
+def matches(path, reference, tolerance):
+
+    #Numeric columns that differ between two outputs, matched on GISJOIN
+    found = pd.DataFrame(gpd.read_file(path).drop(columns = 'geometry'))
+    expected = pd.DataFrame(gpd.read_file(reference).drop(columns = 'geometry'))
+
+    if found.shape[0] != expected.shape[0]:
+        return ['rows ' + str(found.shape[0]) + ' vs ' + str(expected.shape[0]) + ' in ' + os.path.basename(reference)]
+
+    merged = pd.merge(expected, found, on = 'GISJOIN', suffixes = ('_expected', '_found'))
+    problems = []
+    for c in expected.select_dtypes(include = 'number').columns:
+        if not np.allclose(merged[c + '_found'], merged[c + '_expected'], rtol = tolerance, atol = tolerance, equal_nan = True):
+            problems.append(c + ' differs from ' + os.path.basename(reference))
+
+    return problems
+
+
+def compare(result, baseline, time_tolerance, rss_tolerance, result_tolerance, min_phase_seconds = 0.5):
+
+    problems = []
+    if baseline is None:
+        return problems
+
+    if result['returncode'] != 0:
+        return ['failed (exit ' + str(result['returncode']) + ')'] if baseline['returncode'] == 0 else []
+
+    if result['seconds'] > baseline['seconds'] * time_tolerance:
+        problems.append('wall time ' + '%.2f' % result['seconds'] + 's vs baseline ' + '%.2f' % baseline['seconds'] + 's')
+    if result['peak_rss_mb'] > baseline['peak_rss_mb'] * rss_tolerance:
+        problems.append('peak RSS ' + '%.0f' % result['peak_rss_mb'] + 'MB vs baseline ' + '%.0f' % baseline['peak_rss_mb'] + 'MB')
+
+    #Phases long enough to time reliably
+    for name, phase in result.get('phases', {}).items():
+        expected = baseline.get('phases', {}).get(name)
+        if expected is not None and expected['seconds'] >= min_phase_seconds and phase['seconds'] > expected['seconds'] * time_tolerance:
+            problems.append('phase ' + name + ' ' + '%.2f' % phase['seconds'] + 's vs baseline ' + '%.2f' % expected['seconds'] + 's')
+
+    for kind, n in result.get('failures', {}).items():
+        if n > baseline.get('failures', {}).get(kind, 0):
+            problems.append(str(n) + ' ' + kind + ' vs baseline ' + str(baseline.get('failures', {}).get(kind, 0)))
+
+    expected, found = baseline.get('summary'), result.get('summary')
+    if expected is not None and found is not None:
+        if expected['rows'] != found['rows']:
+            problems.append('rows ' + str(found['rows']) + ' vs baseline ' + str(expected['rows']))
+        for c, value in expected['sums'].items():
+            if c not in found['sums']:
+                problems.append('column ' + c + ' missing')
+            elif not np.isclose(found['sums'][c], value, rtol = result_tolerance, atol = result_tolerance):
+                problems.append('sum of ' + c + ' ' + repr(found['sums'][c]) + ' vs baseline ' + repr(value))
+
+    return problems
+
+
+def clear_caches(directory):
+
+    for cache in caches:
+        shutil.rmtree(os.path.join(directory, 'Output', cache), ignore_errors = True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Benchmark pipeline stages on synthetic geographies')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 10000], help = 'Block counts to benchmark (1k to 1M)')
+    parser.add_argument('--stages', type = str, nargs = '+', default = stages, choices = stages, help = 'Stages to run (later stages read earlier stages\' outputs)')
+    parser.add_argument('--data', type = str, default = os.path.join('Benchmarks', 'data'), help = 'Work directory; one subdirectory per size')
+    parser.add_argument('--regenerate', action = 'store_true', help = 'Regenerate synthetic inputs even if they exist')
+    parser.add_argument('--warm', action = 'store_true', help = 'Keep geometry/weight/adjacency caches between runs instead of timing cold runs')
+    parser.add_argument('--radius', type = int, default = 1000, help = 'UDM radius for 3_gmetric_per_block.py')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for the synthetic inputs')
+    parser.add_argument('--baseline', type = str, default = os.path.join('Benchmarks', 'baseline.json'), help = 'Stored baseline results')
+    parser.add_argument('--update_baseline', action = 'store_true', help = 'Write this run\'s results as the new baseline')
+    parser.add_argument('--time_tolerance', type = float, default = 1.25, help = 'Flag stages slower than this multiple of the baseline')
+    parser.add_argument('--rss_tolerance', type = float, default = 1.25, help = 'Flag stages using more than this multiple of the baseline peak RSS')
+    parser.add_argument('--result_tolerance', type = float, default = 1e-6, help = 'Relative tolerance for output column sums')
+    parser.add_argument('--match_tolerance', type = float, default = 1e-9, help = 'Tolerance for outputs that must match another stage\'s (e.g. tiled against serial)')
+    parser.add_argument('--phases', action = 'store_true', help = 'Print per-phase times and peaks under each stage')
+    parser.add_argument('-o', '--output', type = str, default = os.path.join('Benchmarks', 'results.json'), help = 'Results of this run')
+
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}; regressions = []
+    for size in args.sizes:
+        directory = os.path.abspath(os.path.join(args.data, str(size)))
+
+        if args.regenerate or not os.path.exists(os.path.join(directory, 'blocks.shp')):
+            print('\nGenerating ' + str(size) + ' blocks...\n')
+            synthetic.generate(size, directory, seed = args.seed)
+
+        os.makedirs(os.path.join(directory, 'Output', 'zcta_crosswalk'), exist_ok = True)
+        os.makedirs(os.path.join(directory, 'logs'), exist_ok = True)
+        os.makedirs(os.path.join(directory, 'reports'), exist_ok = True)
+
+        for stage in args.stages:
+            script, arguments, output = commands(args.radius)[stage]
+
+            if not args.warm:
+                clear_caches(directory)
+            if os.path.exists(os.path.join(directory, output)) and output.endswith('.csv'):
+                os.remove(os.path.join(directory, output))
+
+            log = os.path.join(directory, 'logs', stage + '.log')
+            report = os.path.join(directory, 'reports', stage + '.json')
+            seconds, rss, returncode = run([sys.executable, os.path.join(root, script)] + arguments, directory, log, report)
+
+            key = str(size) + '/' + stage
+            results[key] = { 'size' : size, 'stage' : stage, 'seconds' : seconds, 'peak_rss_mb' : rss, 'returncode' : returncode, 'summary' : summarize(os.path.join(directory, output)) if returncode == 0 else None }
+            results[key]['phases'], results[key]['failures'], report_rss = phases(report)
+
+            #The report's peak is the stage's own high-water mark; take it where it is higher than rusage
+            if report_rss is not None:
+                results[key]['peak_rss_mb'] = rss = max(rss, report_rss)
+
+            problems = compare(results[key], baseline.get(key), args.time_tolerance, args.rss_tolerance, args.result_tolerance)
+            if returncode == 0 and stage in references and os.path.exists(os.path.join(directory, references[stage])):
+                problems += matches(os.path.join(directory, output), os.path.join(directory, references[stage]), args.match_tolerance)
+            regressions.extend([key + ': ' + p for p in problems])
+
+            status = 'ok' if returncode == 0 else 'FAILED (see ' + log + ')'
+            print(key.ljust(32) + ('%9.2f s' % seconds) + ('%9.0f MB' % rss) + '   ' + status + ''.join('\n    ' + p for p in problems))
+            if args.phases:
+                for name, phase in results[key]['phases'].items():
+                    print(('  ' + name).ljust(32) + ('%9.2f s' % phase['seconds']) + ('%9.0f MB' % phase['peak_rss_mb']))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok = True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent = 2)
+        print('\nBaseline written to ' + args.baseline)
+
+    if regressions:
+        print('\n' + str(len(regressions)) + ' regression(s) against ' + args.baseline + ':')
+        for r in regressions:
+            print('    ' + r)
+        sys.exit(1)
@@ -0,0 +1,187 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from scipy.spatial import cKDTree
+
+#Synthetic, fully offline inputs for the pipeline at any scale. Blocks are a square grid of --block_size cells, split
+#into vertical county strips and given GISJOINs in NHGIS form (county code at GISJOIN[4:7]). Precincts are groups of
+#whole blocks around random seeds, as real precincts mostly follow block lines; districts and ZCTAs are Voronoi cells
+#that cut across blocks, so the split-block paths are exercised. The reference ZCTA layer is the ZCTA layer with
+#jittered seeds. Population and party shift smoothly across the state so segregation metrics have signal.
+#
+#Writes, in ESRI:102003: blocks.shp (GISJOIN), demo.csv, precincts.shp (prec_id, county_nam), vr.csv, districts.shp
+#(DISTRICT), zctas.shp and reference.shp (GISJOIN), state.shp (ST).
+
+crs = 'ESRI:102003'
+origin = (1400000.0, -100000.0)
+
+parties = ['DEM', 'REP', 'UNA']
+
+#Party shares of registered voters by race
+party_shares = {
+    'W' : [0.35, 0.45, 0.20],
+    'B' : [0.80, 0.05, 0.15],
+    'O' : [0.45, 0.25, 0.30],
+}
+
+def voronoi(seeds, extent):
+
+    #Cells of seeds clipped to extent, in seed order
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(seeds), extend_to = extent))
+    cells = shapely.intersection(cells, extent)
+
+    order = cKDTree(seeds).query(shapely.get_coordinates(shapely.point_on_surface(cells)))[1]
+    ordered = np.empty(len(seeds), dtype = object)
+    ordered[order] = cells
+
+    return ordered
+
+
+def grid_blocks(n_blocks, block_size, n_counties):
+
+    nx = int(np.ceil(np.sqrt(n_blocks)))
+    k = np.arange(n_blocks)
+    i, j = k % nx, k // nx
+
+    x = origin[0] + i * block_size; y = origin[1] + j * block_size
+    geoms = shapely.box(x, y, x + block_size, y + block_size)
+
+    county = np.minimum(i * n_counties // nx, n_counties - 1)
+    county_codes = np.char.zfill((2 * county + 1).astype(str), 3)
+
+    gisjoin = np.char.add(np.char.add(np.char.add('G370', county_codes), '0'), np.char.zfill(k.astype(str), 10))
+
+    return gpd.GeoDataFrame({ 'GISJOIN' : gisjoin, 'county' : county }, geometry = geoms, crs = crs), np.column_stack([x + block_size / 2, y + block_size / 2])
+
+
+def demographics(centers, rng):
+
+    #Share Black and Hispanic vary smoothly over space; block population is Poisson around a density surface
+    extent = centers.max(axis = 0) - centers.min(axis = 0) + 1
+    u = (centers - centers.min(axis = 0)) / extent
+
+    density = 30 * (0.3 + np.exp(-8 * ((u[:, 0] - 0.3) ** 2 + (u[:, 1] - 0.6) ** 2)) + 0.7 * np.exp(-10 * ((u[:, 0] - 0.75) ** 2 + (u[:, 1] - 0.25) ** 2)))
+    population = rng.poisson(density)
+
+    black = np.clip(0.1 + 0.45 * (0.5 + 0.5 * np.sin(3 * np.pi * u[:, 0]) * np.cos(2 * np.pi * u[:, 1])) + rng.normal(0, 0.05, len(u)), 0, 0.9)
+    hispanic = np.clip(0.05 + 0.15 * u[:, 1] + rng.normal(0, 0.02, len(u)), 0, 0.5)
+    other = np.full(len(u), 0.05)
+    white = np.clip(1 - black - other, 0, 1)
+
+    race = np.column_stack([white, black, other])
+    race = race / race.sum(axis = 1, keepdims = True)
+    shares = np.column_stack([race * (1 - hispanic)[:, None], race * hispanic[:, None]])
+
+    counts = rng.multinomial(population, shares / shares.sum(axis = 1, keepdims = True))
+
+    return pd.DataFrame(counts, columns = ['NL_W', 'NL_B', 'NL_O', 'HL_W', 'HL_B', 'HL_O'])
+
+
+def precinct_layer(blocks, centers, n_precincts, rng):
+
+    seeds = centers[rng.choice(len(centers), n_precincts, replace = False)]
+    precinct = cKDTree(seeds).query(centers)[1]
+
+    #Renumber by first block so every precinct is non-empty and ids are stable
+    _, first, precinct = np.unique(precinct, return_index = True, return_inverse = True)
+
+    order = np.argsort(precinct, kind = 'stable')
+    groups = np.split(order, np.flatnonzero(np.diff(precinct[order])) + 1)
+
+    geoms = [shapely.coverage_union_all(blocks.geometry.values[g]) for g in groups]
+    county = blocks['county'].values[first]
+
+    precincts = gpd.GeoDataFrame({ 'prec_id' : (np.arange(len(groups)) + 1).astype(str), 'county_nam' : np.char.add('C', np.char.zfill((2 * county + 1).astype(str), 3)) }, geometry = geoms, crs = crs)
+
+    return precincts, precinct
+
+
+def voter_registration(demo, precinct, precincts, missing, rng):
+
+    #Registered voters per precinct, race/ethnicity and party, about 70% of population
+    by_precinct = demo.groupby(precinct).sum()
+
+    rows = []
+    for (column, race), ethnic in zip([(c, c[-1]) for c in demo.columns], ['NL', 'NL', 'NL', 'HL', 'HL', 'HL']):
+        registered = rng.binomial(by_precinct[column].to_numpy(), 0.7)
+        by_party = rng.multinomial(registered, party_shares[race])
+
+        for p, party in enumerate(parties):
+            rows.append(pd.DataFrame({ 'precinct' : by_precinct.index, 'party_cd' : party, 'race_code' : race, 'ethnic_code' : ethnic, 'Voters' : by_party[:, p] }))
+
+    vr = pd.concat(rows)
+    vr = vr[vr['Voters'] > 0]
+
+    #A share of precincts without voter data, for the imputation path (at least one, so small trees exercise it too)
+    n_dropped = min(len(precincts), max(1, int(round(missing * len(precincts))))) if missing > 0 else 0
+    dropped = rng.choice(len(precincts), n_dropped, replace = False)
+    vr = vr[~np.isin(vr['precinct'], dropped)]
+
+    vr['county_desc'] = precincts['county_nam'].values[vr['precinct']]
+    vr['precinct_abbrv'] = precincts['prec_id'].values[vr['precinct']]
+
+    return vr[['county_desc', 'precinct_abbrv', 'party_cd', 'race_code', 'ethnic_code', 'Voters']].sort_values(['county_desc', 'precinct_abbrv', 'party_cd', 'race_code', 'ethnic_code'])
+
+
+def generate(n_blocks, directory, n_precincts = None, n_districts = None, n_zctas = None, n_counties = 4, missing_precincts = 0.02, block_size = 100, seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    n_precincts = n_precincts or max(4, n_blocks // 80)
+    n_districts = n_districts or max(4, min(120, n_blocks // 2000))
+    n_zctas = n_zctas or max(4, n_blocks // 300)
+
+    os.makedirs(directory, exist_ok = True)
+
+    blocks, centers = grid_blocks(n_blocks, block_size, n_counties)
+    extent = shapely.box(*blocks.total_bounds)
+
+    demo = demographics(centers, rng)
+    demo.insert(0, 'GISJOIN', blocks['GISJOIN'].values)
+
+    precincts, precinct = precinct_layer(blocks, centers, n_precincts, rng)
+    vr = voter_registration(demo.drop(columns = 'GISJOIN'), precinct, precincts, missing_precincts, rng)
+
+    district_seeds = centers[rng.choice(len(centers), n_districts, replace = False)] + rng.uniform(-block_size / 2, block_size / 2, (n_districts, 2))
+    districts = gpd.GeoDataFrame({ 'DISTRICT' : np.arange(1, n_districts + 1) }, geometry = voronoi(district_seeds, extent), crs = crs)
+
+    zcta_seeds = centers[rng.choice(len(centers), n_zctas, replace = False)] + rng.uniform(-block_size / 2, block_size / 2, (n_zctas, 2))
+    zcta_ids = np.char.zfill((27000 + np.arange(n_zctas)).astype(str), 5)
+    zctas = gpd.GeoDataFrame({ 'GISJOIN' : zcta_ids }, geometry = voronoi(zcta_seeds, extent), crs = crs)
+
+    reference_seeds = zcta_seeds + rng.normal(0, 2 * block_size, zcta_seeds.shape)
+    reference = gpd.GeoDataFrame({ 'GISJOIN' : zcta_ids }, geometry = voronoi(reference_seeds, extent), crs = crs)
+
+    state = gpd.GeoDataFrame({ 'ST' : ['37'] }, geometry = [extent], crs = crs)
+
+    blocks[['GISJOIN', 'geometry']].to_file(os.path.join(directory, 'blocks.shp'))
+    demo.to_csv(os.path.join(directory, 'demo.csv'), index = False)
+    precincts.to_file(os.path.join(directory, 'precincts.shp'))
+    vr.to_csv(os.path.join(directory, 'vr.csv'), index = False)
+    districts.to_file(os.path.join(directory, 'districts.shp'))
+    zctas.to_file(os.path.join(directory, 'zctas.shp'))
+    reference.to_file(os.path.join(directory, 'reference.shp'))
+    state.to_file(os.path.join(directory, 'state.shp'))
+
+    print('Generated ' + str(n_blocks) + ' blocks, ' + str(len(precincts)) + ' precincts, ' + str(n_districts) + ' districts and ' + str(n_zctas) + ' ZCTAs in ' + directory)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Generate synthetic blocks, precincts, districts, ZCTAs and voter registration for benchmarks')
+    parser.add_argument('-n', '--blocks', type = int, default = 10000, help = 'Number of census blocks')
+    parser.add_argument('--precincts', type = int, help = 'Number of precincts (default blocks / 80)')
+    parser.add_argument('--districts', type = int, help = 'Number of districts (default blocks / 2000, between 4 and 120)')
+    parser.add_argument('--zctas', type = int, help = 'Number of ZCTAs (default blocks / 300)')
+    parser.add_argument('--counties', type = int, default = 4, help = 'Number of counties')
+    parser.add_argument('--missing_precincts', type = float, default = 0.02, help = 'Share of precincts left out of the voter registration table')
+    parser.add_argument('--block_size', type = float, default = 100, help = 'Block side length (CRS units)')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Random seed')
+    parser.add_argument('-o', '--output', type = str, help = 'Output directory')
+
+    args = parser.parse_args()
+
+    generate(args.blocks, args.output, args.precincts, args.districts, args.zctas, args.counties, args.missing_precincts, args.block_size, args.seed)
@@ -1,74 +1,237 @@
-import os, sys
+import os, sys, io
+import codecs
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import argparse
 import chardet
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import vr_store
+import instrumentation
+
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.max_rows', 10000)
 
+groupings = {
+    'precinct' : ['county_desc', 'precinct_abbrv'],
+    'zcta' : ['zip_code'],
+    'county' : ['county_desc'],
+    'municipality' : ['municipality_desc'],
+    'congress' : ['cong_dist_abbrv'],
+    'nc_senate' : ['nc_senate_abbrv'],
+    'nc_house' : ['nc_house_abbrv'],
+}
+demographics = ['party_cd', 'race_code', 'ethnic_code']
+
 parser = argparse.ArgumentParser()
 
-parser.add_argument('-v', '--voters', help = 'Individual voter registration records')
-parser.add_argument('-o', '--output', help = 'Output file name')
+parser.add_argument('-v', '--voters', nargs = '+', help = 'Individual voter registration records (one or more snapshots, plain text or zipped)')
+parser.add_argument('-g', '--groupings', nargs = '+', default = ['zcta'], help = 'Groupings to count voters by: ' + ', '.join(groupings))
+parser.add_argument('-o', '--output', help = 'Output file name (one snapshot and one grouping)')
+parser.add_argument('--output_dir', help = 'Output directory; one csv is written per snapshot and grouping')
+parser.add_argument('-n', '--processes', type = int, default = 1, help = 'Number of snapshots to process in parallel')
+parser.add_argument('--store', help = 'Also write the cleaned records to a county-partitioned Parquet store in this directory')
+parser.add_argument('-s', '--stream', action = 'store_true', help = 'Decode, filter and count the voter file in bounded-size chunks instead of loading it whole')
+parser.add_argument('-c', '--chunk_size', type = int, default = 64, help = 'Approximate size (MB) of each raw chunk read in --stream mode')
 
 args = parser.parse_args()
 
-def decode():
-    failed = 0; total = 0
-    with open('NCRawData/vr/VR_20061020_encodingconvert.txt', 'w') as o:
-        for i, line in enumerate(open('NCRawData/vr/VR_20061020.txt', 'rb')):
-            #print(chardet.detect(line))
-            
-            total += 1
+encodings = ['utf-8', 'UTF-16LE', 'ascii']
+
+def open_raw(path):
+
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        return archive.open(archive.namelist()[0])
+
+    return open(path, 'rb')
+
+
+def detect_encoding(sample):
+
+    #One encoding per snapshot, from a BOM, the NUL bytes of BOM-less UTF-16 (zipped snapshots are UTF-16LE), or
+    #chardet when the sample is not UTF-8. UTF-8 must not go first: UTF-16 bytes decode as UTF-8, laced with NULs.
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    if sample[1::2].count(0) > len(sample) // 4:
+        return 'utf-16-le'
+    if sample[0::2].count(0) > len(sample) // 4:
+        return 'utf-16-be'
+
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return chardet.detect(sample)['encoding'] or 'utf-8'
+
+
+def line_count(block):
+
+    return block.count('\n' if isinstance(block, str) else b'\n') + (0 if block[-1:] in ['\n', b'\n'] else 1)
+
+
+def decode_block(block, encoding, counter):
+
+    #Single-byte and UTF-8 blocks are bytes cut at a newline; nearly every one decodes whole, so only fall back to
+    #per-line decoding when it fails
+    try:
+        return block.decode(encoding)
+    except UnicodeDecodeError:
+        pass
+
+    decoded = []
+    for i, line in enumerate(block.split(b'\n')):
+        for fallback in [encoding] + encodings:
             try:
-                o.write(line.decode())
-                #print(line.decode() + '\n')
-            except:
-                try:    
-                    o.write(line.decode(encoding = 'UTF-16LE'))
-                except:
-                    try:
-                        o.write(line.decode(encoding = 'ascii'))
-                    except:
-                        failed += 1
-                        print('Skipping line ' + str(i) + '\n')
+                decoded.append(line.decode(encoding = fallback))
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            counter['failed'] += 1
+            print('Skipping line ' + str(counter['lines'] + i) + '\n')
+
+    return '\n'.join(decoded)
+
+
+def drop_undecodable(text, counter):
+
+    #UTF-16 blocks are decoded incrementally with replacement characters; lines holding one are skipped
+    if '\ufffd' not in text:
+        return text
+
+    kept = []
+    for i, line in enumerate(text.split('\n')):
+        if '\ufffd' in line:
+            counter['failed'] += 1
+            print('Skipping line ' + str(counter['lines'] + i) + '\n')
+        else:
+            kept.append(line)
+
+    return '\n'.join(kept)
+
+
+def read_blocks(path, chunk_size, counter):
+
+    #Blocks of about chunk_size MB (a chunk_size of 0 reads the whole file) that end on a line boundary. UTF-16 is
+    #decoded before lines are split, as its newlines are two bytes; other encodings are split as bytes.
+    size = chunk_size * 1024 * 1024 if chunk_size > 0 else -1
+
+    with open_raw(path) as raw:
+        data = raw.read(size)
+        encoding = detect_encoding(data[:65536])
+        wide = encoding.startswith('utf-16')
+        decoder = codecs.getincrementaldecoder(encoding)(errors = 'replace') if wide else None
+
+        tail = '' if wide else b''
+        while len(data) > 0:
+            block = tail + (decoder.decode(data) if wide else data)
+
+            data = raw.read(size) if size > 0 else b''
+            if len(data) == 0:
+                block, tail = block + (decoder.decode(b'', final = True) if wide else b''), block[:0]
+            else:
+                cut = block.rfind('\n' if wide else b'\n') + 1
+                block, tail = block[:cut], block[cut:]
+
+            if len(block) == 0:
+                continue
+
+            text = drop_undecodable(block, counter) if wide else decode_block(block, encoding, counter)
+            counter['lines'] += line_count(block)
+
+            yield text
+
+
+def clean(vr):
+
+    vr = vr[(vr['status_cd'].str.strip() == 'A') & (vr['reason_cd'].str.strip() == 'AV')].copy()
+
+    party = vr['party_cd'].astype(str).str.strip()
+    vr['party_cd'] = party.where(party.isin(['DEM', 'REP', 'UNA']), 'OP')
+    race = vr['race_code'].astype(str).str.strip()
+    vr['race_code'] = race.where(race.isin(['B', 'W', 'U']), 'OR')
+
+    return vr
+
+
+def count_snapshot(path, names, chunk_size, store = None, snapshot = None):
+
+    keys = { name : groupings[name] + demographics for name in names }
+    usecols = list(dict.fromkeys([c for name in names for c in keys[name]] + ['status_cd', 'reason_cd']))
+
+    if store is not None:
+        usecols = list(dict.fromkeys(usecols + vr_store.precinct_keys))
+        vr_store.reset_snapshot(store, snapshot)
+
+    #Empty counts per grouping, so an empty file or one no line of which decodes still writes (empty) tables
+    counter = { 'failed' : 0, 'lines' : 0 }
+    columns = None; counts = { name : pd.Series(0, index = pd.MultiIndex.from_arrays([[]] * len(keys[name]), names = keys[name]), dtype = int) for name in names }
+    for part, text in enumerate(read_blocks(path, chunk_size, counter)):
+        #The header is the first non-blank line, wherever it falls in the first blocks
+        while columns is None and text != '':
+            header, _, text = text.partition('\n')
+            if header.strip() != '':
+                columns = [c.strip().strip('"') for c in header.split('\t')]
+
+        if text.strip() == '':
+            continue
+
+        chunk = pd.read_csv(io.StringIO(text), sep = '\t', header = None, names = columns, usecols = usecols, dtype = str, on_bad_lines = 'warn')
+        chunk = clean(chunk)
+
+        if store is not None:
+            vr_store.write_chunk(chunk, store, snapshot, part)
 
-    print(str(failed) + ' lines failed total (' + str(failed/total) + '%).')
+        #Every grouping is counted off the same parsed chunk
+        for name in names:
+            chunk_counts = chunk.groupby(keys[name]).size()
+            counts[name] = counts[name].add(chunk_counts, fill_value = 0)
 
+    print(path + ': ' + str(counter['failed']) + ' lines failed total (' + str(counter['failed']/max(1, counter['lines'])) + '%).')
 
-def precinct(args):
-        
-    #vr = pd.read_csv(args.voters, encoding = 'UTF-16LE', compression = 'zip', sep = '\t', on_bad_lines='warn', engine = 'python')
-    vr = pd.read_csv('NCRawData/vr/VR_20061020_encodingconvert.txt', sep = '\t', on_bad_lines='warn', engine = 'python')
+    return { name : counts[name].astype(int).reset_index(name = 'Voters') for name in names }, counter
 
-    vr = vr[(vr['status_cd'].str.strip() == 'A') & (vr['reason_cd'].str.strip() == 'AV')]
-    
-    vr['party_cd'] = vr['party_cd'].astype(str).map(lambda x : x.strip() if x.strip() in ['DEM', 'REP', 'UNA'] else 'OP')
-    vr['race_code'] = vr['race_code'].astype(str).map(lambda x : x.strip() if x.strip() in ['B', 'W', 'U'] else 'OR')
 
-    vr = vr.groupby(['county_desc', 'precinct_abbrv', 'party_cd', 'race_code', 'ethnic_code']).size().reset_index(name='Voters')
+def group_snapshot(path, args):
 
-    vr.to_csv(args.output)
+    snapshot = os.path.basename(path).split('.')[0]
+    chunk_size = args.chunk_size if args.stream else 0
 
+    counts, counter = count_snapshot(path, args.groupings, chunk_size, args.store, snapshot)
+    for name, vr in counts.items():
+        vr.to_csv(os.path.join(args.output_dir, snapshot + '_' + name + '.csv') if args.output_dir else args.output)
 
-def zcta(args):
-    
-    #vr = pd.read_csv(args.voters, encoding = 'UTF-16LE', compression = 'zip', sep = '\t', on_bad_lines='warn', engine = 'python')
-    vr = pd.read_csv('NCRawData/vr/VR_20061020_encodingconvert.txt', sep = '\t', on_bad_lines='warn', engine = 'python')
+    return snapshot, counter
 
-    vr = vr[(vr['status_cd'].str.strip() == 'A') & (vr['reason_cd'].str.strip() == 'AV')]
 
-    vr['party_cd'] = vr['party_cd'].astype(str).map(lambda x : x.strip() if x.strip() in ['DEM', 'REP', 'UNA'] else 'OP')
-    vr['race_code'] = vr['race_code'].astype(str).map(lambda x : x.strip() if x.strip() in ['B', 'W', 'U'] else 'OR')
+if __name__ == '__main__':
 
-    vr = vr.groupby(['zip_code', 'party_cd', 'race_code', 'ethnic_code']).size().reset_index(name='Voters')
+    unknown = [name for name in args.groupings if name not in groupings]
+    if len(unknown) > 0:
+        parser.error('Unknown grouping(s): ' + ', '.join(unknown))
 
-    vr.to_csv(args.output)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok = True)
+    elif args.output is None:
+        parser.error('One of -o/--output or --output_dir is required')
+    elif len(args.voters) > 1 or len(args.groupings) > 1:
+        parser.error('-o/--output takes one snapshot and one grouping; use --output_dir for several')
 
+    instrumentation.start(__file__, args)
+    instrumentation.step('group', snapshots = len(args.voters))
 
+    lines = 0
+    with ProcessPoolExecutor(max_workers = args.processes) as pool:
+        for snapshot, counter in pool.map(group_snapshot, args.voters, [args] * len(args.voters)):
+            print('Finished ' + snapshot)
 
-#decode()
-#precinct(args)
-zcta(args)
+            #Lines no encoding could decode are skipped in the workers; the run report counts them
+            lines += counter['lines']
+            instrumentation.failure('undecodable_lines', counter['failed'])
 
+    instrumentation.rows('lines', lines)
 
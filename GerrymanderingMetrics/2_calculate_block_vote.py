@@ -5,9 +5,17 @@ import numpy as np
 import pandas as pd
 import geopandas as gpd
 import shapely
+import scipy.sparse as sp
 from scipy.spatial import cKDTree
 import argparse
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import vr_store
+import block_weights
+import geometry_cache
+import adjacency
+import instrumentation
+
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -17,16 +25,27 @@ pd.set_option('display.max_rows', 10000)
 parser = argparse.ArgumentParser()
 
 parser.add_argument('-v', '--voters', help = 'Precinct-level vote results (csv)')
+parser.add_argument('--vr_store', help = 'Snapshot directory of the Parquet voter store (read instead of --voters)')
+parser.add_argument('--counties', nargs = '+', help = 'Only read these counties (county_desc) from --vr_store')
 parser.add_argument('-p', '--precincts', help = 'Precincts shapefile')
 parser.add_argument('-i', '--impute', action = 'store_true', help = 'Impute vote data from missing precincts using neighboring precincts')
+parser.add_argument('--impute_weight', choices = ['population', 'boundary'], default = 'population', help = 'Pool neighboring precincts by population (their voters over their population), or average their vote shares weighted by shared boundary length')
+parser.add_argument('--impute_hops', type = int, default = 3, help = 'Precincts with no adjacent precinct with data are imputed from neighbors up to this many steps away')
 parser.add_argument('-b', '--blocks', help = 'Blocks shapefile')
 parser.add_argument('-d', '--demographics', help = 'Block-level demographic variables (csv)')
 parser.add_argument('-o', '--output', help = 'Output file name')
 
 args = parser.parse_args()
 
-precinct_vr_raw = pd.read_csv(args.voters)
-precinct_vr_raw['precinct_abbrv'] = ['0'*(6-len(str(pid).strip())) + str(pid).strip() for pid in precinct_vr_raw['precinct_abbrv']]
+instrumentation.start(__file__, args)
+
+instrumentation.step('load')
+
+if args.vr_store:
+    precinct_vr_raw = vr_store.precinct_counts(args.vr_store, args.counties)
+else:
+    precinct_vr_raw = pd.read_csv(args.voters)
+    precinct_vr_raw['precinct_abbrv'] = vr_store.pad_precinct(precinct_vr_raw['precinct_abbrv'])
 
 precinct_vr_r = precinct_vr_raw.groupby(['county_desc', 'precinct_abbrv', 'race_code', 'party_cd'], as_index = False).sum().rename(columns = { 'race_code' : 're_code'})
 precinct_vr_e = precinct_vr_raw.groupby(['county_desc', 'precinct_abbrv', 'ethnic_code', 'party_cd'], as_index = False).sum().rename(columns = { 'ethnic_code' : 're_code'})
@@ -35,15 +54,17 @@ precinct_vr_a['re_code'] = 'ALL'
 
 precinct_vr = pd.concat([precinct_vr_r, precinct_vr_e, precinct_vr_a])
 
-print(precinct_vr.head(30))
+instrumentation.rows('voter_records', precinct_vr_raw.shape[0])
+instrumentation.rows('precinct_vr', precinct_vr.shape[0])
 
-precinct_shp = gpd.read_file(args.precincts).to_crs('ESRI:102003')
+precinct_shp = geometry_cache.load(args.precincts)
 precinct_shp.columns = [x.lower() for x in precinct_shp.columns]
 if 'seims_code' in precinct_shp.columns:
     precinct_shp['prec_id'] = precinct_shp['seims_code']
     precinct_shp['county_nam'] = precinct_shp['county'].str.upper()
 precinct_shp = precinct_shp[['prec_id', 'county_nam', 'geometry']]
-precinct_shp['prec_id'] = ['0'*(6-len(str(pid).strip())) + str(pid).strip() for pid in precinct_shp['prec_id']]
+precinct_shp['prec_id'] = vr_store.pad_precinct(precinct_shp['prec_id'])
+instrumentation.rows('precincts', precinct_shp.shape[0])
 
 shared = [i for i in precinct_shp['prec_id'].tolist() if i in precinct_vr_raw['precinct_abbrv'].tolist()]
 
@@ -54,111 +75,160 @@ block_pop['W'] = block_pop['NL_W'] + block_pop['HL_W']
 block_pop['HL'] = block_pop['HL_W'] + block_pop['HL_B'] + block_pop['HL_O']
 block_pop['NL'] = block_pop['NL_W'] + block_pop['NL_B'] + block_pop['NL_O']
 block_pop = block_pop[['GISJOIN', 'ALL', 'HL', 'NL', 'B', 'W']]
-block_pop = pd.melt(block_pop, id_vars = ['GISJOIN'])
-block_pop = block_pop.rename(columns = { 'variable' : 're_code', 'value' : 'Population' })
+block_pop_wide = block_pop
+re_codes = ['ALL', 'HL', 'NL', 'B', 'W']
 
-block_shp_raw = gpd.read_file(args.blocks).to_crs('ESRI:102003')
+block_shp_raw = geometry_cache.load(args.blocks)
 block_shp_raw = block_shp_raw[['GISJOIN', 'geometry']]
+instrumentation.rows('blocks', block_shp_raw.shape[0])
+
+def allocate(weights, block_population, precinct_vr_by_shape):
+
+    #Block totals as sparse products over the (block x precinct) weights. Voters are rounded per (block, precinct)
+    #pair before summing, and block populations only count precincts with voter data for that race/ethnicity.
+    n_precincts = weights.shape[1]
+
+    def precinct_vector(rows, values):
+        vector = np.zeros(n_precincts)
+        vector[rows['precinct'].to_numpy()] = values
+        return vector
+
+    population = {}
+    for re_code, rows in precinct_vr_by_shape.groupby('re_code'):
+        has_vr = precinct_vector(rows.drop_duplicates('precinct'), 1)
+        population[re_code] = block_population[:, re_codes.index(re_code)] * (weights @ has_vr)
 
-block_shp = pd.merge(block_shp_raw, block_pop, on = 'GISJOIN')
+    voters = {}
+    for (re_code, party_cd), rows in precinct_vr_by_shape.groupby(['re_code', 'party_cd']):
+        pair_voters = weights.multiply(block_population[:, [re_codes.index(re_code)]]).multiply(precinct_vector(rows, rows['PropVote'].to_numpy())[None, :]).tocsr()
+        pair_voters.data = np.round(pair_voters.data)
+        voters[party_cd + '_' + re_code] = np.asarray(pair_voters.sum(axis = 1)).ravel().astype(int)
 
-def final_process_contained_blocks(contained_blocks):
+    parties = { c[:-len('_ALL')] : voters[c] for c in voters if c.endswith('_ALL') }
 
-    contained_blocks['Voters'] = contained_blocks['PropVote'] * contained_blocks['Population']
-    contained_blocks['Voters'] = contained_blocks['Voters'].map(lambda x : int(round(x)))
-    contained_blocks['pre_code'] = contained_blocks['party_cd'] + '_' + contained_blocks['re_code']
+    #Blocks in at least one precinct with voter data
+    included = (weights @ precinct_vector(precinct_vr_by_shape[precinct_vr_by_shape['re_code'] == 'ALL'].drop_duplicates('precinct'), 1)) > 0
 
-    contained_blocks_p = pd.pivot_table(contained_blocks[contained_blocks['re_code'] == 'ALL'][['GISJOIN', 'party_cd', 'Voters']].groupby(['GISJOIN', 'party_cd'], as_index = False).sum(), index = ['GISJOIN'], columns = ['party_cd'])
-    contained_blocks_re = pd.pivot_table(contained_blocks[['GISJOIN', 're_code', 'Population']].groupby(['GISJOIN', 're_code'], as_index = False).first(), index = ['GISJOIN'], columns = ['re_code'])
-    contained_blocks_v = pd.pivot_table(contained_blocks[['GISJOIN', 'pre_code', 'Voters']].groupby(['GISJOIN', 'pre_code'], as_index = False).sum(), index = ['GISJOIN'], columns = ['pre_code'])
+    blocks = pd.DataFrame({ 'GISJOIN' : block_shp_raw['GISJOIN'].to_numpy() })
+    for columns in [population, voters, parties]:
+        for c in sorted(columns):
+            blocks[c] = columns[c]
 
-    contained_blocks = pd.merge(pd.merge(contained_blocks_re, contained_blocks_v, on = 'GISJOIN'), contained_blocks_p, on = 'GISJOIN').droplevel(0, axis=1).rename_axis(None, axis=1).reset_index()
-    
-    contained_blocks = contained_blocks.fillna(0)
+    return blocks[included].reset_index(drop = True)
 
-    return contained_blocks
+def impute(missing_idx, precinct_vr_by_shape, binary, lengths, weight, hops):
 
-blocks_with_stats = pd.DataFrame()
-count = 0; missing_precincts = []; prop_vote_precincts = []
-for index, precinct in tqdm(precinct_shp.iterrows(), total=precinct_shp.shape[0]):
-    
-    contained_blocks = block_shp[block_shp.geometry.within(precinct.geometry)]
+    #Vote shares for precincts without voter data from the precincts around them, as (precinct, re_code, party_cd,
+    #PropVote) rows for allocate. Precincts with data are columns of sparse (precinct x re_code/party) matrices, so each
+    #hop is one sparse product for every missing precinct at once. With population weighting, neighbors' voters and
+    #populations are pooled; with boundary weighting, their shares are averaged by shared boundary length (path
+    #products of lengths beyond the first hop). Both reach the same neighbors: precincts meeting only at a corner
+    #weigh one unit of length, so they count when nothing else is adjacent but barely move an average over real edges.
+    groups = precinct_vr_by_shape.groupby(['re_code', 'party_cd'])
+    combos = groups.size().reset_index()[['re_code', 'party_cd']]
 
-    contained_blocks['Overlap'] = 1
+    shape = (binary.shape[0], combos.shape[0])
+    rows = precinct_vr_by_shape['precinct'].to_numpy(); cols = groups.ngroup().to_numpy()
 
-    overlap_blocks = block_shp[block_shp.geometry.intersects(precinct.geometry) & ~block_shp.geometry.within(precinct.geometry)]
+    def matrix(values):
+        return sp.csr_matrix((values, (rows, cols)), shape = shape)
 
-    overlaps = []
-    for index, block in overlap_blocks.iterrows():
-        overlaps.append(block.geometry.buffer(0).intersection(precinct.geometry.buffer(0)).area/block.geometry.area)
+    voters = matrix(precinct_vr_by_shape['Voters'].to_numpy(dtype = float))
+    population = matrix(precinct_vr_by_shape['Population'].to_numpy(dtype = float))
+    prop_vote = matrix(precinct_vr_by_shape['PropVote'].to_numpy(dtype = float))
+    has_vr = matrix(np.ones(len(rows)))
 
-    overlap_blocks['Overlap'] = overlaps
-    overlap_blocks['Overlap'] = overlap_blocks['Overlap'].map(lambda x : 0 if x < 0.01 else (1 if x > 0.99 else x))
-    overlap_blocks = overlap_blocks[overlap_blocks['Overlap'] > 0]
+    has_any = np.zeros(shape[0]); has_any[np.unique(rows)] = 1
+
+    step = binary if weight == 'population' else binary.maximum(lengths).tocsr()
+    reach = step[missing_idx]
+
+    imputed = []; hop = np.zeros(len(missing_idx), dtype = int)
+    for k in range(1, hops + 1):
+        if k > 1:
+            reach = (reach @ step).tocsr()
+            if weight == 'population':
+                reach.data[:] = 1
+
+        found = np.flatnonzero((hop == 0) & (reach @ has_any > 0))
+        if len(found) == 0:
+            continue
+        hop[found] = k
+
+        r = reach[found]
+        present = (r @ has_vr).toarray()
+        if weight == 'population':
+            shares = (r @ voters).toarray() / np.maximum(1, (r @ population).toarray())
+        else:
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                shares = (r @ prop_vote).toarray() / present
 
-    contained_blocks = pd.concat([contained_blocks, overlap_blocks])
+        i, j = np.nonzero(present > 0)
+        imputed.append(pd.DataFrame({ 'precinct' : missing_idx[found[i]], 're_code' : combos['re_code'].values[j], 'party_cd' : combos['party_cd'].values[j], 'PropVote' : shares[i, j] }))
 
-    contained_blocks['Population'] = contained_blocks['Population'] * contained_blocks['Overlap']
-    
-    current_precinct_vr = precinct_vr[(precinct_vr['county_desc'] == precinct['county_nam']) & (precinct_vr['precinct_abbrv'] == precinct['prec_id'])]
-   
-    if current_precinct_vr.shape[0] == 0:
-        contained_blocks_missing = contained_blocks
-        contained_blocks_missing['prec_id'] = precinct['prec_id']
-        missing_precincts.append(contained_blocks)
+    imputed = pd.concat(imputed) if len(imputed) > 0 else pd.DataFrame(columns = ['precinct', 're_code', 'party_cd', 'PropVote'])
 
-    contained_blocks = contained_blocks.drop(columns = ['Overlap', 'geometry'])
+    return imputed, hop
 
-    precinct_total_population = contained_blocks.groupby('re_code', as_index = False).sum()
-    
-    current_precinct_vr = pd.merge(current_precinct_vr, precinct_total_population, on = ['re_code'])
-    current_precinct_vr['PropVote'] = current_precinct_vr['Voters']/current_precinct_vr['Population'].map(lambda x : max(1, x))
-    
-    prop_vote_precincts.append(current_precinct_vr[['county_desc', 'precinct_abbrv', 're_code', 'party_cd', 'Voters', 'Population']])
-    current_precinct_vr = current_precinct_vr[['re_code', 'party_cd', 'PropVote']]
-   
-    contained_blocks = pd.merge(contained_blocks, current_precinct_vr, on = ['re_code'])
+print('\nOverlaying blocks and precincts...\n')
+instrumentation.step('overlay')
 
-    contained_blocks = final_process_contained_blocks(contained_blocks)
-    
-    if count == 0:
-        blocks_with_stats = contained_blocks
-    else:
-        blocks_with_stats = pd.concat([blocks_with_stats, contained_blocks])
+#Sparse (block x precinct) overlap fractions, cached across runs; columns are positional indices into precinct_shp
+weights = block_weights.overlap_matrix(block_shp_raw, precinct_shp, block_shp_raw['GISJOIN'], precinct_shp['county_nam'] + '_' + precinct_shp['prec_id'])
 
-    count += 1
+block_population = block_pop_wide.drop_duplicates('GISJOIN').set_index('GISJOIN').reindex(block_shp_raw['GISJOIN'])[re_codes]
 
+#Blocks without demographics take no part, as in an inner merge
+weights = (sp.diags(block_population.notna().all(axis = 1).to_numpy(dtype = float)) @ weights).tocsr()
+weights.eliminate_zeros()
+instrumentation.rows('block_precinct_pairs', weights.nnz)
+instrumentation.failure('blocks_without_demographics', (~block_population.notna().all(axis = 1)).sum())
+block_population = block_population.fillna(0).to_numpy()
+
+precinct_keys = precinct_shp[['county_nam', 'prec_id']].reset_index(drop = True).rename_axis('precinct').reset_index()
+precinct_vr_by_shape = pd.merge(precinct_keys, precinct_vr, left_on = ['county_nam', 'prec_id'], right_on = ['county_desc', 'precinct_abbrv'])
+
+missing_idx = np.setdiff1d(precinct_keys['precinct'], precinct_vr_by_shape['precinct'].unique())
+instrumentation.failure('precincts_without_vr', len(missing_idx))
+
+print('\nAllocating precinct voters to blocks...\n')
+instrumentation.step('allocate')
+
+precinct_population = weights.T @ block_population
+precinct_total_population = pd.DataFrame(precinct_population, columns = re_codes)[np.diff(weights.tocsc().indptr) > 0].rename_axis('precinct').reset_index().melt(id_vars = ['precinct'], var_name = 're_code', value_name = 'Population')
+
+precinct_vr_by_shape = pd.merge(precinct_vr_by_shape, precinct_total_population, on = ['precinct', 're_code'])
+precinct_vr_by_shape['PropVote'] = precinct_vr_by_shape['Voters']/precinct_vr_by_shape['Population'].clip(lower = 1)
+
+blocks_with_stats = allocate(weights, block_population, precinct_vr_by_shape)
 
 #IMPUTING NOT YET THOROUGHLY TESTED, AND NOT APPLIED IN PRELIMINARY WORK
 imputed_gisjoins = []
-if args.impute:
-    for precinct in missing_precincts:
-        precinct_geo = precinct[['geometry']].dissolve()
+if args.impute and len(missing_idx) > 0:
+    print('\nImputing ' + str(len(missing_idx)) + ' precincts without voter data from their neighbors...\n')
+    instrumentation.step('impute')
 
-        nearest_precincts = [(p['county_desc'], p['precinct_abbrv']) for _,p in precinct_shp[precinct_shp.geometry.touches(precinct.geometry)].iterrows()]
-        nearest_precincts_prop_vote = [p for p in prop_vote_precincts if (p['county_desc'], p['precinct_abbrv']) in nearest_precincts]
+    #Precinct contiguity (and shared boundary lengths), cached across runs
+    binary, lengths = adjacency.contiguity(precinct_shp.geometry.values, precinct_shp['county_nam'] + '_' + precinct_shp['prec_id'])
 
-        if len(nearest_precincts_prop_vote) == 0:
-            print('\nWARNING: Missing voter registration data for precinct and it could not be imputed from adjacent precincts.\n')
-            continue
-        else:
-            nearest_precincts_prop_vote = pd.concat(nearest_precincts_prop_vote)
-            nearest_precincts_prop_vote = nearest_precincts_prop_vote[['re_code', 'party_cd', 'Voters', 'Population']]
-            current_precinct_vr = nearest_precincts_prop_vote.groupby(['re_code', 'party_code'], as_index = False).sum()
-            current_precinct_vr['PropVote'] = current_precinct_vr['Voters']/current_precinct_vr['Population'].map(lambda x : max(1, x))
-            current_precinct_vr = current_precinct_vr[['re_code', 'party_cd', 'PropVote']]
+    imputed_vr, hop = impute(missing_idx, precinct_vr_by_shape, binary, lengths, args.impute_weight, args.impute_hops)
+
+    for k in range(1, args.impute_hops + 1):
+        if (hop == k).sum() > 0:
+            print(str((hop == k).sum()) + ' imputed from precincts ' + str(k) + ' step(s) away')
+    instrumentation.failure('unimputed_precincts', (hop == 0).sum())
+    if (hop == 0).sum() > 0:
+        print('\nWARNING: Missing voter registration data for ' + str((hop == 0).sum()) + ' precincts that could not be imputed from precincts within ' + str(args.impute_hops) + ' steps: ' + ', '.join(precinct_shp['county_nam'].values[missing_idx[hop == 0]] + ' ' + precinct_shp['prec_id'].values[missing_idx[hop == 0]]) + '\n')
 
-            precinct = precinct.drop(columns = ['Overlap', 'geometry'])
-            contained_blocks = pd.merge(precinct, current_precinct_vr, on = 're_code')
-            contained_blocks = final_process_contained_blocks(contained_blocks)
-            imputed_gisjoins.extend(contained_blocks['GISJOIN']).tolist()
+    imputed_blocks = allocate(weights, block_population, imputed_vr)
+    imputed_gisjoins = imputed_blocks['GISJOIN'].tolist()
 
-            blocks_with_stats = pd.concat([blocks_with_stats, contained_blocks])
-        
+    blocks_with_stats = pd.concat([blocks_with_stats, imputed_blocks])
+
+instrumentation.step('write')
 
 blocks_with_stats = blocks_with_stats.groupby('GISJOIN', as_index = False).sum()
-blocks_with_stats['imputed'] = blocks_with_stats['GISJOIN'].map(lambda x : True if x in imputed_gisjoins else False)
+blocks_with_stats['imputed'] = blocks_with_stats['GISJOIN'].isin(imputed_gisjoins)
 blocks_with_stats = gpd.GeoDataFrame(pd.merge(blocks_with_stats, block_shp_raw, on = 'GISJOIN'))
+instrumentation.rows('blocks', blocks_with_stats.shape[0])
 blocks_with_stats.to_file(args.output)
-
-
@@ -7,163 +7,295 @@ import geopandas as gpd
 from scipy.spatial import cKDTree
 import argparse
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import areal_weights
+import geometry_cache
+import udm
+import udm_grid
+import opd
+import tiling
+import incremental
+import instrumentation
+
 pd.set_option('display.max_columns', 500)
 
 parser = argparse.ArgumentParser('Calculate localized redistricting inequality statistics')
 
 parser.add_argument('-b', '--blocks', type = str, help = 'A shapefile of census blocks containing the number of voters in various demographic/party groups.')
 parser.add_argument('-d', '--districts', type = str, help = 'A shapefile of legislative districts.')
+parser.add_argument('-p', '--plans', type = str, nargs = '+', help = 'Several district shapefiles to evaluate in one run against the same blocks; -o is then an output directory.')
+parser.add_argument('-a', '--assignments', type = str, help = 'A csv of block -> district assignments (GISJOIN plus one column per plan) to evaluate in one run; -o is then an output directory.')
 parser.add_argument('--udm', action = 'store_true', help = 'Calculate UDM.')
 parser.add_argument('--opd', action = 'store_true', help = 'Calculate opposed partisan dislocation.')
 parser.add_argument('-gv', '--group_var', type = str, help = 'The variable (column name) in the blocks file corresponding to the number of voters of a specific target group.')
 parser.add_argument('-ov', '--opposition_var', type = str, help = 'The variable (column name) in the blocks file corresponding to the number of voters in a specific "opposition" group.')
 parser.add_argument('-tv', '--total_var', type = str, help = 'The variable (column name) in the blocks file corresponding to the total population.')
-parser.add_argument('-r', '--entropy_radius', type = str, help = 'The radius in which to calculate uncertainty of district membership for the given group of voters.')
+parser.add_argument('-r', '--entropy_radius', type = str, nargs = '+', help = 'The radius in which to calculate uncertainty of district membership for the given group of voters. Several radii run as one sweep, with one column per group and radius (dem_500, rep_500, nw_500, ...).')
 parser.add_argument('-o', '--output', type = str, help = 'Output file name and path')
+parser.add_argument('-n', '--processes', type = int, default = 1, help = 'Number of processes for UDM/OPD; above 1, blocks are split into spatial tiles run in parallel.')
+parser.add_argument('--tile_size', type = float, default = 20000, help = 'Side length (in CRS units) of the spatial tiles used with --processes.')
+parser.add_argument('--opd_halo', type = float, help = 'Halo (in CRS units) around each tile for OPD neighbourhoods; estimated from population density if not given.')
+parser.add_argument('--incremental', action = 'store_true', help = 'With several plans, update each plan from the previous one, recomputing only the blocks its changes can reach.')
+parser.add_argument('--udm_engine', choices = ['exact', 'grid'], default = 'exact', help = 'exact: ball queries per block. grid: approximate, binning voters onto a grid and convolving each district with a disk kernel (serial; for very large runs).')
+parser.add_argument('--grid_cell', type = float, default = 50, help = 'Grid cell size (in CRS units) for --udm_engine grid.')
+parser.add_argument('--grid_max_cells', type = int, default = udm_grid.max_cells, help = 'Largest raster (in cells) for --udm_engine grid; bigger districts are split into tiles.')
+parser.add_argument('--grid_reference_county', type = str, help = 'With --udm_engine grid, also run the exact engine on the blocks of this county (county code, GISJOIN[4:7]) and report the grid error there.')
+
+def load_districts(path):
+
+    sldls = geometry_cache.load(path)
+
+    if 'district' in sldls.columns:
+        sldls['DISTRICT'] = sldls['district']
+    elif 'DISTRICT_C' in sldls.columns:
+        sldls['DISTRICT'] = sldls['DISTRICT_C']
+
+    print(path)
+    instrumentation.rows('districts', sldls.shape[0])
+
+    return sldls
+
+
+def weight_centroids(centroids):
+
+    centroids['ALL'] = centroids['ALL'] * centroids['propoverlap']
+    centroids['W'] = centroids['W'] * centroids['propoverlap']
+    centroids['DEM'] = centroids['DEM'] * centroids['propoverlap']
+    centroids['REP'] = centroids['REP'] * centroids['propoverlap']
+    centroids['DEM_B'] = centroids['DEM_B'] * centroids['propoverlap']
+    centroids['REP_W'] = centroids['REP_W'] * centroids['propoverlap']
+
+    return centroids
+
+
+def shape_centroids(sldls):
+
+    print('\nAssigning blocks to districts...\n')
+
+    #Blocks fully inside one district take the fast path; only boundary blocks are intersected exactly
+    with instrumentation.phase('overlay'):
+        block_districts = areal_weights.block_overlaps(blocks, sldls, snap = None, keep_zero = True, geometries = True).sort_values(['block', 'target'])
+        instrumentation.rows('block_district_pairs', block_districts.shape[0])
+
+    districts_block_indexed = {
+        'GISJOIN' : blocks['GISJOIN'].values[block_districts['block']],
+        'district' : sldls['DISTRICT'].values[block_districts['target']],
+        'propoverlap' : block_districts['overlap'].values,
+        'geometry' : block_districts['geometry'].values,
+    }
+
+    #NOTE: Multiple rows per GISJOIN if a block falls into multiple districts
+    centroids = gpd.GeoDataFrame.from_dict(districts_block_indexed)
+    centroids = pd.merge(centroids, blocks.drop(columns = 'geometry'), on = 'GISJOIN')
+    centroids.geometry = centroids.geometry.centroid
+
+    return weight_centroids(centroids)
+
+
+def assignment_centroids(districts):
+
+    #Whole blocks, one row each, at the block centroid; blocks without an assignment are left out
+    centroids = gpd.GeoDataFrame(blocks.drop(columns = 'geometry'), geometry = block_centroids.values)
+    centroids['district'] = districts.values
+    centroids['propoverlap'] = 1
+
+    return weight_centroids(centroids[centroids['district'].notna()].reset_index(drop = True))
+
+
+def sweep_columns(sweep):
+
+    return { g.split('_')[0] + '_' + ('%g' % r) : sweep[r][g] for r in sorted(sweep) for g in udm.groups }
+
+
+def grid_error(centroid_tree, codes, weights, sweep, name = None):
+
+    county = np.flatnonzero(blocks['GISJOIN'].str[4:7].values == args.grid_reference_county)
+    if len(county) == 0:
+        print('\nWARNING: No blocks in reference county ' + args.grid_reference_county + ', grid UDM error not measured\n')
+        instrumentation.failure('grid_reference_county_empty')
+        return
+
+    exact = udm.udm_sweep(centroid_tree, codes, weights, block_coordpairs[county], radii)
+    approximate = { r : { g : sweep[r][g][county] for g in udm.groups } for r in sweep }
+
+    report = udm_grid.error_report(exact, approximate)
+    report.insert(0, 'county', args.grid_reference_county)
+    report.insert(1, 'cell', args.grid_cell)
+
+    #Next to the output: <output>_grid_error.csv, or <plan>_grid_error.csv in the output directory
+    path = os.path.join(args.output, name + '_grid_error.csv') if name is not None else os.path.splitext(args.output)[0] + '_grid_error.csv'
+    report.to_csv(path, index = False)
+
+    print('\nGrid UDM error against the exact engine in county ' + args.grid_reference_county + ' (cell size ' + str(args.grid_cell) + '), written to ' + path + '\n')
+    print(report)
+    print('\n')
+
+
+def block_metrics(centroids, args, centroid_tree = None, name = None):
+
+    centroid_coordpairs = np.column_stack([centroids.geometry.x, centroids.geometry.y])
+
+    if centroid_tree is None:
+        print('\nCreating K-D tree...\n')
+        with instrumentation.phase('kdtree', centroids = len(centroid_coordpairs)):
+            centroid_tree = cKDTree(centroid_coordpairs)
+
+    entropies = None
+    if args.udm:
+        print('\nFinding neighbors per block and calculating Uncertainty of District Membership...\n')
+
+        with instrumentation.phase('udm'):
+            codes, _ = udm.district_codes(centroids)
+
+            if args.udm_engine == 'grid':
+                sweep, rasters = udm_grid.grid_sweep(centroid_coordpairs, codes, udm.group_weights(centroids), block_coordpairs, radii, args.grid_cell, args.grid_max_cells)
+
+                for k, v in rasters.items():
+                    instrumentation.rows('grid_' + k, v)
+                if rasters['tiled_districts'] > 0:
+                    print(str(rasters['tiled_districts']) + ' of ' + str(rasters['districts']) + ' districts split into ' + str(rasters['tiles']) + ' tiles to stay within ' + str(args.grid_max_cells) + ' raster cells')
+
+                if args.grid_reference_county:
+                    grid_error(centroid_tree, codes, udm.group_weights(centroids), sweep, name)
+
+                entropies = sweep_columns(sweep) if len(radii) > 1 else sweep[radii[0]]
+            elif len(radii) > 1:
+                #One neighbour pass at the largest radius for the whole sweep
+                if args.processes > 1:
+                    sweep = tiling.tiled_udm(centroid_coordpairs, codes, udm.group_weights(centroids), block_coordpairs, max(radii), args.processes, args.tile_size, radii)
+                else:
+                    sweep = udm.udm_sweep(centroid_tree, codes, udm.group_weights(centroids), block_coordpairs, radii)
+
+                entropies = sweep_columns(sweep)
+            elif args.processes > 1:
+                entropies = tiling.tiled_udm(centroid_coordpairs, codes, udm.group_weights(centroids), block_coordpairs, radii[0], args.processes, args.tile_size)
+            else:
+                entropies = udm.udm_entropies(centroid_tree, codes, udm.group_weights(centroids), block_coordpairs, radii[0])
+
+    opd_table, reached = None, None
+    if args.opd:
+        print('\nFinding neighbors per block and calculating Opposed Partisan Dislocation...\n')
+
+        with instrumentation.phase('opd'):
+            opd_table, reached = opd.opd_neighbors(centroids, centroid_tree, centroid_coordpairs, args.processes, args.tile_size, args.opd_halo)
+
+    return assemble(entropies, opd_table, reached, args)
+
+
+def assemble(entropies, opd_table, reached, args):
+
+    udm_neighbor_data_blocks = []
+    if args.udm:
+        udm_neighbor_data_blocks = blocks.drop(columns = 'geometry')
+        for group, e in entropies.items():
+            udm_neighbor_data_blocks[group] = e
+
+    opd_neighbor_data_blocks = []
+    if args.opd:
+        instrumentation.failure('opd_unreached', (~reached).sum())
+        if not reached.all():
+            print('OPD calculation failed for ' + str((~reached).sum()) + ' blocks: district population could not be reached')
+        opd_neighbor_data_blocks = opd_table[reached]
+
+        opd_neighbor_data_blocks = opd_neighbor_data_blocks.groupby('GISJOIN', as_index = False).mean()
+        opd_neighbor_data_blocks = pd.merge(opd_neighbor_data_blocks, blocks.drop(columns = ['geometry']), on = 'GISJOIN')
+
+    if args.udm and args.opd:
+        neighbor_data_blocks = pd.merge(udm_neighbor_data_blocks, opd_neighbor_data_blocks)
+    elif args.udm:
+        neighbor_data_blocks = udm_neighbor_data_blocks
+    elif args.opd:
+        neighbor_data_blocks = opd_neighbor_data_blocks
+
+    neighbor_data_blocks = pd.merge(neighbor_data_blocks, blocks[['GISJOIN', 'geometry']], on = 'GISJOIN')
+
+    return gpd.GeoDataFrame(neighbor_data_blocks)
+
+
+baseline = None
+
+def plan_metrics(centroids, args, centroid_tree = None, name = None):
+
+    global baseline
+
+    if not args.incremental:
+        return block_metrics(centroids, args, centroid_tree, name)
+
+    #Serial engines only: each plan is an update of the previous plan's result
+    radius = radii[0] if args.udm else None
+
+    if baseline is None:
+        with instrumentation.phase('evaluate'):
+            baseline = incremental.evaluate(centroids, block_coordpairs, radius, args.opd, centroid_tree)
+    else:
+        changed = incremental.changed_blocks(baseline['centroids'], centroids)
+        with instrumentation.phase('update', changed = len(changed)):
+            baseline = incremental.update(baseline, centroids, changed, blocks, block_coordpairs, radius, args.opd)
+
+        print(str(len(changed)) + ' blocks changed district; recomputed UDM for ' + str(baseline.get('udm_recomputed', 0)) + ' blocks and OPD for ' + str(baseline.get('opd_recomputed', 0)) + ' block pieces')
+
+    return assemble(*incremental.results(baseline), args)
+
+
+#Workers started by spawn/forkserver import this file; everything that loads data or runs stays under the guard
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    radii = [int(r) for r in args.entropy_radius] if args.entropy_radius else []
+    if args.incremental and len(radii) > 1:
+        parser.error('--incremental takes a single --entropy_radius')
+    if args.incremental and args.udm_engine == 'grid':
+        parser.error('--incremental uses the exact UDM engine')
+
+    instrumentation.start(__file__, args)
+
+    print('\nLoading shapefiles...\n')
+    instrumentation.step('load')
+
+    #Stage 2 output changes every run, so it is read directly rather than cached (it is already in the cache CRS)
+    blocks = gpd.read_file(args.blocks)[['ALL', 'W', 'DEM', 'REP', 'DEM_B', 'REP_W', 'geometry', 'GISJOIN']]
+    instrumentation.rows('blocks', blocks.shape[0])
+
+    block_centroids = blocks.geometry.centroid
+    block_coordpairs = np.column_stack([block_centroids.x, block_centroids.y])
+
+    if args.plans or args.assignments:
+        os.makedirs(args.output, exist_ok = True)
+
+        for path in args.plans or []:
+            plan = os.path.basename(path).split('.')[0]
+            print('\nPlan ' + plan + '\n')
+            instrumentation.step('plan ' + plan)
+
+            neighbor_data_blocks = plan_metrics(shape_centroids(load_districts(path)), args, name = plan)
+
+            with instrumentation.phase('write', blocks = neighbor_data_blocks.shape[0]):
+                neighbor_data_blocks.to_file(os.path.join(args.output, plan + '.shp'))
+
+        if args.assignments:
+            instrumentation.step('load assignments')
+
+            assignments = pd.read_csv(args.assignments, dtype = { 'GISJOIN' : str })
+            assignments = pd.merge(blocks[['GISJOIN']], assignments, on = 'GISJOIN', how = 'left')
 
-args = parser.parse_args()
-
-print('\nLoading shapefiles...\n')
-
-blocks = gpd.read_file(args.blocks).to_crs('ESRI:102003')[['ALL', 'W', 'DEM', 'REP', 'DEM_B', 'REP_W', 'geometry', 'GISJOIN']]
-
-sldls = gpd.read_file(args.districts).to_crs('ESRI:102003')
-
-if 'district' in sldls.columns:
-    sldls['DISTRICT'] = sldls['district']
-elif 'DISTRICT_C' in sldls.columns:
-    sldls['DISTRICT'] = sldls['DISTRICT_C']
-
-print(args.districts)
-print(sldls.columns)
-print('\n\n')
-
-print('\nAssigning blocks to districts...\n')
-
-districts_block_indexed = { 'GISJOIN' : [], 'district' : [], 'propoverlap' : [], 'geometry' : [] }
-for index, block in tqdm(blocks.iterrows(), total = blocks.shape[0]):
-    block_districts = sldls[sldls.geometry.intersects(block.geometry)]
-    
-    for i2, dist in block_districts.iterrows():
-        sect_geo = block.geometry.buffer(0).intersection(dist.geometry.buffer(0))
-        prop_overlap = sect_geo.area/block.geometry.area
-        districts_block_indexed['district'].append(dist['DISTRICT'])
-        districts_block_indexed['GISJOIN'].append(block['GISJOIN'])
-        districts_block_indexed['propoverlap'].append(prop_overlap)
-        districts_block_indexed['geometry'].append(sect_geo)
-
-#NOTE: Multiple rows per GISJOIN if a block falls into multiple districts
-centroids = gpd.GeoDataFrame.from_dict(districts_block_indexed)
-centroids = pd.merge(centroids, blocks.drop(columns = 'geometry'), on = 'GISJOIN')
-centroids.geometry = centroids.geometry.centroid
-
-centroids['ALL'] = centroids['ALL'] * centroids['propoverlap']
-centroids['W'] = centroids['W'] * centroids['propoverlap']
-centroids['DEM'] = centroids['DEM'] * centroids['propoverlap']
-centroids['REP'] = centroids['REP'] * centroids['propoverlap']
-centroids['DEM_B'] = centroids['DEM_B'] * centroids['propoverlap']
-centroids['REP_W'] = centroids['REP_W'] * centroids['propoverlap']
-
-print('\nCreating K-D tree...\n')
-
-centroid_coordpairs = np.array(list(centroids.geometry.apply(lambda x: (x.x, x.y))))
-centroid_tree = cKDTree(centroid_coordpairs)
-
-udm_neighbor_data_blocks = []
-if args.udm:
-    print('\nFinding neighbors per block and calculating Uncertainty of District Membership...\n')
-    
-    for index, block in tqdm(blocks.iterrows(), total = blocks.shape[0]):
-            radius_idxs = centroid_tree.query_ball_point((block.geometry.centroid.x, block.geometry.centroid.y), int(args.entropy_radius))
-            radius_blocks = centroids.iloc[radius_idxs]
-
-            radius_blocks = radius_blocks.fillna(0)
-            #radius_blocks['distance'] = radius_blocks.geometry.distance(block.geometry.centroid)
-           
-            #Democrats
-            d = [dist for i, dist in enumerate(radius_blocks['district'].tolist()) for f in range(int(radius_blocks['DEM'].tolist()[i]))]
-            p = [d.count(dist)/len(d) for dist in list(dict.fromkeys(d))]
-            e = -sum([pr * np.log2(pr) for pr in p])
-            block['dem_udm'] = e
-
-            #Republicans
-            d = [dist for i, dist in enumerate(radius_blocks['district'].tolist()) for f in range(int(radius_blocks['REP'].tolist()[i]))]
-            p = [d.count(dist)/len(d) for dist in list(dict.fromkeys(d))]
-            e = -sum([pr * np.log2(pr) for pr in p])
-            block['rep_udm'] = e
-
-            #Non-White
-            d = [dist for i, dist in enumerate(radius_blocks['district'].tolist()) for f in range(int(radius_blocks['ALL'].tolist()[i]) - int(radius_blocks['W'].tolist()[i]))]
-            p = [d.count(dist)/len(d) for dist in list(dict.fromkeys(d))]
-            e = -sum([pr * np.log2(pr) for pr in p])
-            block['nw_udm'] = e
-
-            udm_neighbor_data_blocks.append(block.to_dict())
-
-    udm_neighbor_data_blocks = gpd.GeoDataFrame(udm_neighbor_data_blocks).drop(columns = 'geometry')
-
-opd_neighbor_data_blocks = []
-if args.opd:
-    print('\nFinding neighbors per block and calculating Opposed Partisan Dislocation...\n')
-    
-    districts_for_counts = centroids['district'].tolist()
-    blocks_per_district = { dist: districts_for_counts.count(dist) for dist in list(dict.fromkeys(districts_for_counts)) }
-
-    pw_centroids = pd.DataFrame()
-    pw_centroids['GISJOIN'] = centroids['GISJOIN'].repeat(centroids['ALL'])
-    pw_centroids['geometry'] = centroids['geometry'].repeat(centroids['ALL'])
-    pw_centroid_tree = cKDTree(np.array(list(pw_centroids.geometry.apply(lambda x: (x.x, x.y)))))
-
-    for index, block in tqdm(centroids.iterrows(), total = centroids.shape[0]):
-        try:
-            district_total_pop, district_dem, district_rep, district_w, district_demb, district_repw = centroids[centroids['district'] == block['district']][['ALL', 'DEM', 'REP', 'W', 'DEM_B', 'REP_W']].sum().to_list()     
-
-            dist, idx = pw_centroid_tree.query((block.geometry.x, block.geometry.y), district_total_pop)
-            knn = list(dict.fromkeys(pd.DataFrame(pw_centroids.iloc[idx])['GISJOIN'].tolist()))
-            knn_blocks = centroids[centroids['GISJOIN'].isin(knn)]
-            
-            #Partisan dislocation
-            knn_total_pop, knn_dem, knn_rep = knn_blocks[['ALL', 'DEM', 'REP']].sum().to_list()
-            block['knn_total'] = knn_total_pop
-            block['knn_dem'] = knn_dem
-            block['knn_rep'] = knn_rep
-            block['sld_total'] = district_total_pop
-            block['sld_dem'] = district_dem
-            block['sld_rep'] = district_rep
-
-            #Racial dislocation
-            knn_w = knn_blocks[['W']].sum().to_list()[0]
-            block['knn_nw'] = knn_total_pop - knn_w
-            block['sld_nw'] = district_total_pop - district_w
-
-            #Opposed party-race dislocation
-            knn_demb, knn_repw = knn_blocks[['DEM_B', 'REP_W']].sum().tolist()
-            block['knn_demb'] = knn_demb
-            block['knn_repw'] = knn_repw
-            block['sld_demb'] = district_demb
-            block['sld_repw'] = district_repw
-
-            opd_neighbor_data_blocks.append(block.to_dict())
-        except Exception as e:
-            print('OPD calculation failed for one block with error ' + str(e))
-
-    opd_neighbor_data_blocks = pd.DataFrame(opd_neighbor_data_blocks)[['knn_total', 'knn_dem', 'knn_rep', 'sld_total', 'sld_dem', 'sld_rep', 'knn_nw', 'sld_nw', 'knn_demb', 'knn_repw', 'sld_demb', 'sld_repw', 'GISJOIN']]
-    opd_neighbor_data_blocks = opd_neighbor_data_blocks.groupby('GISJOIN', as_index = False).mean()
-    opd_neighbor_data_blocks = pd.merge(opd_neighbor_data_blocks, blocks.drop(columns = ['geometry']), on = 'GISJOIN')
-
-if args.udm and args.opd:
-    neighbor_data_blocks = pd.merge(udm_neighbor_data_blocks, opd_neighbor_data_blocks)
-elif args.udm:
-    neighbor_data_blocks = udm_neighbor_data_blocks
-elif args.opd:
-    neighbor_data_blocks = opd_neighbor_data_blocks
-
-neighbor_data_blocks = pd.merge(neighbor_data_blocks, blocks[['GISJOIN', 'geometry']], on = 'GISJOIN')
-neighbor_data_blocks = gpd.GeoDataFrame(neighbor_data_blocks)
-
-neighbor_data_blocks.to_file(args.output)
+            #With whole-block assignments the centroids never move, so one tree serves every fully assigned plan
+            block_tree = cKDTree(block_coordpairs)
 
+            for plan in [c for c in assignments.columns if c != 'GISJOIN']:
+                print('\nPlan ' + plan + '\n')
+                instrumentation.step('plan ' + plan)
 
+                centroids = assignment_centroids(assignments[plan])
+                centroid_tree = block_tree if centroids.shape[0] == blocks.shape[0] else None
 
+                neighbor_data_blocks = plan_metrics(centroids, args, centroid_tree, plan)
 
+                with instrumentation.phase('write', blocks = neighbor_data_blocks.shape[0]):
+                    neighbor_data_blocks.to_file(os.path.join(args.output, plan + '.shp'))
+    else:
+        instrumentation.step('metrics')
+        neighbor_data_blocks = block_metrics(shape_centroids(load_districts(args.districts)), args)
 
+        instrumentation.step('write', blocks = neighbor_data_blocks.shape[0])
+        neighbor_data_blocks.to_file(args.output)
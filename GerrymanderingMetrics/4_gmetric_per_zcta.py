@@ -1,78 +1,114 @@
 import os, sys
+import re
 import geopandas as gpd
 import pandas as pd
 from tqdm import tqdm
 import numpy as np
+import scipy.sparse as sp
 import argparse
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import block_weights
+import geometry_cache
+import instrumentation
+
 parser = argparse.ArgumentParser('Calculate localized redistricting inequality statistics')
 parser.add_argument('-g', '--gmetrics', type = str, help = 'Shapefile with gerrymandering metrics at the census block level')
 parser.add_argument('-d', '--demographics', type = str, help = 'Block-level race/ethnicity population data')
 parser.add_argument('-z', '--zctas', type = str, help = 'ZCTA-level shapefile')
 parser.add_argument('-i', '--zcta_id', type = str, help = 'Variable to identify ZCTAs')
+parser.add_argument('-t', '--targets', type = str, nargs = '+', help = 'Several target shapefiles (ZCTAs, counties, tracts, FQHC catchments, ...) to summarize in one run; -o is then an output directory.')
+parser.add_argument('--target_ids', type = str, nargs = '+', help = 'The variable identifying units in each of --targets, in the same order.')
 parser.add_argument('-o', '--output', type = str, help = 'Output file name')
 
 args = parser.parse_args()
 
-zctas = gpd.read_file(args.zctas).to_crs('ESRI:102003')
+if args.targets:
+    if not args.target_ids or len(args.target_ids) != len(args.targets):
+        parser.error('--target_ids needs one variable per file in --targets')
+    layers = list(zip(args.targets, args.target_ids))
+else:
+    layers = [(args.zctas, args.zcta_id)]
+
+instrumentation.start(__file__, args)
 
+instrumentation.step('load')
+#Stage 3 output changes every run and is read once, so it is not worth caching (it is already in the cache CRS)
 blocks = gpd.read_file(args.gmetrics)
 #blocks = pd.merge(blocks, gpd.read_file(args.demographics).to_crs('ESRI:102003')[['GISJOIN', 'ALL', 'W', 'DEM', 'REP', 'DEM_B', 'REP_W']], on = 'GISJOIN')
 
-block_overlap_by_zcta = pd.DataFrame(); count = 0
-for index, zcta in tqdm(zctas.iterrows(), total=zctas.shape[0]):
-    try:
-        contained_blocks = blocks[blocks.geometry.within(zcta.geometry)]
-        contained_blocks['overlap'] = 1
-        
-        overlap_blocks = blocks[blocks.geometry.intersects(zcta.geometry) & ~blocks.geometry.within(zcta.geometry)]
-        overlaps = []
-        for index, block in overlap_blocks.iterrows():
-            block_prop_overlap = block.geometry.buffer(0).intersection(zcta.geometry.buffer(0)).area/block.geometry.area
-            if block_prop_overlap > 0.01:
-                if block_prop_overlap > 0.99:
-                    overlaps.append(1)
-                else:
-                    overlaps.append(block_prop_overlap)
-            else:
-                block_overlaps.append(0)
-
-        overlap_blocks['block_overlap'] = overlaps
-        overlap_blocks = overlap_blocks[overlap_blocks['block_overlap'] > 0]
-
-        zcta_blocks = pd.concat([contained_blocks, overlap_blocks])
-        zcta_blocks[args.zcta_id] = zcta[args.zcta_id]
-        zcta_blocks = zcta_blocks.drop(columns = ['geometry'])
-
-        if count == 0:
-            block_overlap_by_zcta = zcta_blocks
-        else:
-            block_overlap_by_zcta = pd.concat([block_overlap_by_zcta, zcta_blocks])
-        
-        count += 1
-    except:
-        print('One ZCTA failed for ' + args.zctas)
-
-block_overlap_by_zcta['ALL'] = block_overlap_by_zcta['ALL'] * block_overlap_by_zcta['overlap']
-block_overlap_by_zcta['dem_udm'] = block_overlap_by_zcta['dem_udm'] * block_overlap_by_zcta['ALL']
-block_overlap_by_zcta['rep_udm'] = block_overlap_by_zcta['rep_udm'] * block_overlap_by_zcta['ALL']
-block_overlap_by_zcta['nw_udm'] = block_overlap_by_zcta['nw_udm'] * block_overlap_by_zcta['ALL']
-
-block_overlap_by_zcta['party_pd'] = (block_overlap_by_zcta['sld_dem']/(block_overlap_by_zcta['sld_dem'] + block_overlap_by_zcta['sld_rep']) - block_overlap_by_zcta['knn_dem']/(block_overlap_by_zcta['knn_dem'] + block_overlap_by_zcta['knn_rep'])) * block_overlap_by_zcta['ALL']
-block_overlap_by_zcta['race_rd'] = (block_overlap_by_zcta['sld_nw']/block_overlap_by_zcta['sld_total'] - block_overlap_by_zcta['knn_nw']/block_overlap_by_zcta['knn_total']) * block_overlap_by_zcta['ALL']
-block_overlap_by_zcta['race_opd'] = (block_overlap_by_zcta['sld_demb']/(block_overlap_by_zcta['sld_demb'] + block_overlap_by_zcta['sld_repw']) - block_overlap_by_zcta['knn_demb']/(block_overlap_by_zcta['knn_demb'] + block_overlap_by_zcta['knn_repw'])) * block_overlap_by_zcta['ALL']
-
-block_overlap_by_zcta = block_overlap_by_zcta[[args.zcta_id, 'ALL', 'dem_udm', 'rep_udm', 'nw_udm', 'party_pd', 'race_rd', 'race_opd']]
-block_overlap_by_zcta = block_overlap_by_zcta.groupby(args.zcta_id, as_index = False).sum()
-
-block_overlap_by_zcta['dem_udm'] = block_overlap_by_zcta['dem_udm']/block_overlap_by_zcta['ALL']
-block_overlap_by_zcta['rep_udm'] = block_overlap_by_zcta['rep_udm']/block_overlap_by_zcta['ALL']
-block_overlap_by_zcta['nw_udm'] = block_overlap_by_zcta['nw_udm']/block_overlap_by_zcta['ALL']
-block_overlap_by_zcta['party_pd'] = block_overlap_by_zcta['party_pd']/block_overlap_by_zcta['ALL']
-block_overlap_by_zcta['race_rd'] = block_overlap_by_zcta['race_rd']/block_overlap_by_zcta['ALL']
-block_overlap_by_zcta['race_opd'] = block_overlap_by_zcta['race_opd']/block_overlap_by_zcta['ALL']
-
-zctas = pd.merge(zctas, block_overlap_by_zcta, on = args.zcta_id)
-
-zctas.to_file(args.output)
+#Per-block metrics, each averaged over a unit's blocks weighted by the population (ALL x overlap) they put in it.
+#UDM columns are <group>_udm for one radius or <group>_<radius> for a sweep; OPD columns are there if stage 3 ran --opd.
+block_metrics = { c : blocks[c] for c in blocks.columns if re.fullmatch(r'(dem|rep|nw)_(udm|[0-9.e+]+)', c) }
+
+if all(c in blocks.columns for c in ['sld_dem', 'sld_rep', 'knn_dem', 'knn_rep', 'sld_nw', 'sld_total', 'knn_nw', 'knn_total', 'sld_demb', 'sld_repw', 'knn_demb', 'knn_repw']):
+    block_metrics['party_pd'] = blocks['sld_dem']/(blocks['sld_dem'] + blocks['sld_rep']) - blocks['knn_dem']/(blocks['knn_dem'] + blocks['knn_rep'])
+    block_metrics['race_rd'] = blocks['sld_nw']/blocks['sld_total'] - blocks['knn_nw']/blocks['knn_total']
+    block_metrics['race_opd'] = blocks['sld_demb']/(blocks['sld_demb'] + blocks['sld_repw']) - blocks['knn_demb']/(blocks['knn_demb'] + blocks['knn_repw'])
+
+if len(block_metrics) == 0:
+    parser.error(args.gmetrics + ' has no UDM (<group>_udm or <group>_<radius>) or OPD columns to summarize')
+
+population = blocks['ALL'].fillna(0).to_numpy(dtype = float)
+instrumentation.rows('blocks', blocks.shape[0])
+
+#Blocks with an undefined metric add population but nothing to the sum, as a groupby sum skipping NaN did
+weighted = np.column_stack([population] + [population * values.to_numpy(dtype = float) for values in block_metrics.values()])
+weighted[np.isnan(weighted)] = 0
+
+print('\nOverlaying blocks and target layers...\n')
+instrumentation.step('overlay')
+
+targets = []; weights = []
+for path, unit_id in tqdm(layers):
+    units = geometry_cache.load(path)
+    instrumentation.rows(os.path.basename(path), units.shape[0])
+
+    targets.append(units)
+    weights.append(block_weights.overlap_matrix(blocks, units, blocks['GISJOIN'], units[unit_id]))
+
+instrumentation.step('aggregate')
+
+#Every unit of every layer in one (unit x block) @ (block x metric) product
+weights = sp.hstack(weights).tocsc()
+sums = weights.T @ weighted
+blocks_per_unit = np.diff(weights.indptr)
+
+instrumentation.step('write')
+
+start = 0
+for (path, unit_id), units in zip(layers, targets):
+    end = start + units.shape[0]
+
+    summary = pd.DataFrame({ unit_id : units[unit_id].to_numpy(), 'ALL' : sums[start:end, 0] })
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        for j, name in enumerate(block_metrics):
+            summary[name] = sums[start:end, j + 1] / summary['ALL']
+
+    if args.targets:
+        os.makedirs(args.output, exist_ok = True)
+        name = os.path.basename(path).split('.')[0]
+        output = os.path.join(args.output, name + '.shp')
+        failed_output = os.path.join(args.output, name + '_failed.csv')
+    else:
+        output = args.output
+        failed_output = os.path.splitext(args.output)[0] + '_failed.csv'
+
+    #Units without a usable summary are reported rather than dropped silently
+    reasons = np.where(blocks_per_unit[start:end] == 0, 'no blocks', np.where(summary['ALL'] <= 0, 'no population', ''))
+    failed = pd.DataFrame({ unit_id : summary[unit_id], 'reason' : reasons })[reasons != '']
+
+    for reason, n in failed['reason'].value_counts().items():
+        instrumentation.failure(reason.replace(' ', '_'), n)
+
+    if failed.shape[0] > 0:
+        counts = ', '.join(str(n) + ' ' + reason for reason, n in failed['reason'].value_counts().items())
+        print(path + ': ' + str(failed.shape[0]) + ' of ' + str(units.shape[0]) + ' units could not be summarized (' + counts + '), see ' + failed_output)
+        failed.to_csv(failed_output, index = False)
+
+    #Units that contain no part of any block have no row, as before
+    summary = summary[blocks_per_unit[start:end] > 0]
+
+    pd.merge(units, summary, on = unit_id).to_file(output)
 
+    start = end
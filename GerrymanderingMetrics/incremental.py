@@ -0,0 +1,134 @@
+import os, sys
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+
+import udm
+import opd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import pop_knn
+
+#Incremental UDM/OPD for small plan edits. evaluate() computes a full result and keeps what later updates need
+#(trees, per-piece neighbourhood radii, district totals); update() takes that baseline and the blocks whose
+#district changed and only recomputes what those blocks can reach:
+#  - UDM for blocks whose entropy radius touches a changed block
+#  - knn_* for block pieces that are themselves changed, sit in a district whose totals changed, or whose
+#    neighbourhood reaches a changed block that is split, added or dropped (its points move or reweight)
+#  - sld_* from the new district totals
+
+def piece_coords(centroids):
+
+    return np.column_stack([centroids.geometry.x, centroids.geometry.y])
+
+
+def evaluate(centroids, block_coordpairs, radius = None, with_opd = True, tree = None):
+
+    coords = piece_coords(centroids)
+    state = { 'centroids' : centroids, 'coords' : coords, 'tree' : cKDTree(coords) if tree is None else tree, 'block_tree' : None }
+
+    if radius is not None:
+        codes, _ = udm.district_codes(centroids)
+        state['entropies'] = udm.udm_entropies(state['tree'], codes, udm.group_weights(centroids), block_coordpairs, radius)
+
+    if with_opd:
+        totals = opd.district_totals(centroids)
+        weights, block_codes, block_totals = opd.neighborhood_inputs(centroids)
+
+        knn, knn_radius, reached = pop_knn.neighborhood_sums(state['tree'], weights, block_codes, block_totals, coords, opd.targets(centroids, totals))
+        state.update({ 'totals' : totals, 'knn' : knn, 'knn_radius' : knn_radius, 'reached' : reached })
+
+    return state
+
+
+def changed_blocks(old_centroids, new_centroids):
+
+    #Blocks whose set of (district, overlap) pieces differs between two plans
+    def pieces(centroids):
+        return set(zip(centroids['GISJOIN'], centroids['district'], centroids['propoverlap'].round(9)))
+
+    return sorted({ p[0] for p in pieces(old_centroids) ^ pieces(new_centroids) })
+
+
+def update(state, centroids, changed, blocks, block_coordpairs, radius = None, with_opd = True):
+
+    coords = piece_coords(centroids)
+    same_points = coords.shape == state['coords'].shape and np.array_equal(coords, state['coords'])
+
+    new = { 'centroids' : centroids, 'coords' : coords, 'tree' : state['tree'] if same_points else cKDTree(coords) }
+    new['block_tree'] = state['block_tree'] if state['block_tree'] is not None else cKDTree(block_coordpairs)
+
+    changed = set(changed)
+    changed_idx = np.flatnonzero(blocks['GISJOIN'].isin(changed).to_numpy())
+
+    if radius is not None:
+        new['entropies'] = { g : e.copy() for g, e in state['entropies'].items() }
+
+        #Any piece of a changed block lies inside the block, so grow the radius by the block's reach from its centroid
+        bounds = shapely.bounds(blocks.geometry.values[changed_idx])
+        dx = np.maximum(np.abs(bounds[:, 0] - block_coordpairs[changed_idx, 0]), np.abs(bounds[:, 2] - block_coordpairs[changed_idx, 0]))
+        dy = np.maximum(np.abs(bounds[:, 1] - block_coordpairs[changed_idx, 1]), np.abs(bounds[:, 3] - block_coordpairs[changed_idx, 1]))
+        reach = np.sqrt(dx**2 + dy**2)
+
+        hits = [new['block_tree'].query_ball_point(p, radius + r) for p, r in zip(block_coordpairs[changed_idx], reach)]
+        affected = np.unique(np.concatenate([np.asarray(h, dtype = np.int64) for h in hits])) if len(hits) > 0 else np.zeros(0, dtype = np.int64)
+
+        if len(affected) > 0:
+            codes, _ = udm.district_codes(centroids)
+            entropies = udm.udm_entropies(new['tree'], codes, udm.group_weights(centroids), block_coordpairs[affected], radius)
+            for g, e in entropies.items():
+                new['entropies'][g][affected] = e
+
+        new['udm_recomputed'] = len(affected)
+
+    if with_opd:
+        totals = opd.district_totals(centroids)
+        weights, block_codes, block_totals = opd.neighborhood_inputs(centroids)
+
+        old_totals = state['totals'].reindex(totals.index)
+        unchanged_districts = totals.index[(old_totals == totals).all(axis = 1).to_numpy()]
+
+        old_pieces = state['centroids'][['GISJOIN', 'district']].assign(old_row = np.arange(state['centroids'].shape[0]))
+        pieces = pd.merge(centroids[['GISJOIN', 'district']], old_pieces, on = ['GISJOIN', 'district'], how = 'left')
+
+        old_rows = pieces['old_row'].to_numpy()
+        reuse = ~np.isnan(old_rows) & ~pieces['GISJOIN'].isin(changed).to_numpy() & pieces['district'].isin(unchanged_districts).to_numpy()
+        old_rows = np.where(reuse, old_rows, 0).astype(np.int64)
+        reuse &= state['reached'][old_rows]
+
+        #A changed block that is one whole piece in both plans keeps its point and weight. Any other changed block
+        #(split, added or dropped) moves or reweights points, so neighbourhoods that reach it must be redone
+        whole = lambda c: set(c['GISJOIN'][c['propoverlap'].to_numpy() == 1]) - set(c['GISJOIN'][c['GISJOIN'].duplicated()])
+        stationary = whole(state['centroids']) & whole(centroids)
+        moving = changed - stationary
+
+        moved = np.vstack([state['coords'][state['centroids']['GISJOIN'].isin(moving).to_numpy()], coords[centroids['GISJOIN'].isin(moving).to_numpy()]])
+
+        if len(moved) > 0 and reuse.any():
+            nearest, _ = cKDTree(moved).query(coords[reuse])
+            keep = state['knn_radius'][old_rows[reuse]] < nearest
+            reuse[np.flatnonzero(reuse)[~keep]] = False
+
+        knn = np.zeros((len(coords), block_totals.shape[1])); knn_radius = np.full(len(coords), np.nan); reached = np.zeros(len(coords), dtype = bool)
+        knn[reuse] = state['knn'][old_rows[reuse]]
+        knn_radius[reuse] = state['knn_radius'][old_rows[reuse]]
+        reached[reuse] = True
+
+        rerun = np.flatnonzero(~reuse)
+        if len(rerun) > 0:
+            rerun_knn, rerun_radius, rerun_reached = pop_knn.neighborhood_sums(new['tree'], weights, block_codes, block_totals, coords[rerun], opd.targets(centroids, totals)[rerun])
+            knn[rerun] = rerun_knn; knn_radius[rerun] = rerun_radius; reached[rerun] = rerun_reached
+
+        new.update({ 'totals' : totals, 'knn' : knn, 'knn_radius' : knn_radius, 'reached' : reached, 'opd_recomputed' : len(rerun) })
+
+    return new
+
+
+def results(state):
+
+    #Block entropies and the per-piece OPD table in the form the serial engines return them
+    entropies = state.get('entropies')
+    opd_table = opd.opd_table(state['centroids'], state['knn'], state['totals']) if 'knn' in state else None
+
+    return entropies, opd_table, state.get('reached')
@@ -0,0 +1,75 @@
+import os, sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import pop_knn
+
+import tiling
+
+#Opposed partisan dislocation: compares each block's district with its population-weighted neighbourhood of the
+#same size (the nearest blocks holding as many people as the district).
+
+opd_vars = ['ALL', 'DEM', 'REP', 'W', 'DEM_B', 'REP_W']
+
+columns = ['knn_total', 'knn_dem', 'knn_rep', 'sld_total', 'sld_dem', 'sld_rep', 'knn_nw', 'sld_nw', 'knn_demb', 'knn_repw', 'sld_demb', 'sld_repw', 'GISJOIN']
+
+def district_totals(centroids):
+
+    return centroids[opd_vars].fillna(0).groupby(centroids['district']).sum()
+
+
+def neighborhood_inputs(centroids):
+
+    #Tree points are district pieces of blocks; neighbourhood sums count every piece of each block reached
+    values = centroids[opd_vars].fillna(0)
+    block_codes, _ = pd.factorize(centroids['GISJOIN'])
+    block_totals = values.groupby(block_codes).sum().to_numpy()
+
+    #Whole people only, as the repeated-point tree this replaces did
+    weights = np.trunc(values['ALL'].to_numpy())
+
+    return weights, block_codes, block_totals
+
+
+def targets(centroids, totals):
+
+    #A k-nearest query with a fractional k returns ceil(k) points
+    return np.ceil(centroids['district'].map(totals['ALL']).to_numpy(dtype = float))
+
+
+def opd_table(centroids, knn, totals):
+
+    sld = totals.reindex(centroids['district']).to_numpy()
+
+    opd = pd.DataFrame({
+        'knn_total' : knn[:, 0],
+        'knn_dem' : knn[:, 1],
+        'knn_rep' : knn[:, 2],
+        'sld_total' : sld[:, 0],
+        'sld_dem' : sld[:, 1],
+        'sld_rep' : sld[:, 2],
+        'knn_nw' : knn[:, 0] - knn[:, 3],
+        'sld_nw' : sld[:, 0] - sld[:, 3],
+        'knn_demb' : knn[:, 4],
+        'knn_repw' : knn[:, 5],
+        'sld_demb' : sld[:, 4],
+        'sld_repw' : sld[:, 5],
+        'GISJOIN' : centroids['GISJOIN'].to_numpy(),
+    })
+
+    return opd[columns]
+
+
+def opd_neighbors(centroids, tree, coordpairs, processes = 1, tile_size = 20000, halo = None):
+
+    #One row per centroid (block piece), plus a mask of pieces whose district population could not be reached
+    totals = district_totals(centroids)
+    weights, block_codes, block_totals = neighborhood_inputs(centroids)
+
+    if processes > 1:
+        knn, reached = tiling.tiled_opd(tree, coordpairs, weights, block_codes, block_totals, targets(centroids, totals), processes, tile_size, halo)
+    else:
+        knn, _, reached = pop_knn.neighborhood_sums(tree, weights, block_codes, block_totals, coordpairs, targets(centroids, totals))
+
+    return opd_table(centroids, knn, totals), reached
@@ -0,0 +1,176 @@
+import os, sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from scipy.spatial import cKDTree
+
+import udm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import pop_knn
+
+#Spatially tiled, multi-process UDM and OPD. Query points are split into grid tiles; each worker builds a KD tree over
+#the centroids inside its tile plus a halo and answers the tile's queries from it. Centroid arrays live in shared
+#memory so workers do not each receive a copy. Results are scattered back by row; they match the serial run up to
+#floating-point summation order (Benchmarks/run_benchmarks.py checks this with a tolerance).
+
+shared = {}
+
+def share(arrays):
+
+    segments = []; specs = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        segment = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype = array.dtype, buffer = segment.buf)[...] = array
+
+        segments.append(segment)
+        specs[name] = (segment.name, array.shape, array.dtype.str)
+
+    return segments, specs
+
+
+def release(segments):
+
+    for segment in segments:
+        segment.close()
+        segment.unlink()
+
+
+def attach(specs):
+
+    for name, (segment_name, shape, dtype) in specs.items():
+        segment = shared_memory.SharedMemory(name = segment_name)
+
+        shared[name] = np.ndarray(shape, dtype = dtype, buffer = segment.buf)
+        shared['segment_' + name] = segment
+
+
+def tiles(points, tile_size):
+
+    #Row indices of points grouped by grid cell
+    cells = np.floor((points - points.min(axis = 0)) / tile_size).astype(np.int64)
+    keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+
+    order = np.argsort(keys, kind = 'stable')
+
+    return np.split(order, np.flatnonzero(np.diff(keys[order])) + 1)
+
+
+def window(points, halo):
+
+    #Centroids inside the bounding box of points grown by halo, found through the x-sorted centroid order
+    lo = points.min(axis = 0) - halo; hi = points.max(axis = 0) + halo
+
+    start = np.searchsorted(shared['x_sorted'], lo[0], side = 'left')
+    end = np.searchsorted(shared['x_sorted'], hi[0], side = 'right')
+    candidates = shared['x_order'][start:end]
+
+    y = shared['coords'][candidates, 1]
+
+    return np.sort(candidates[(y >= lo[1]) & (y <= hi[1])]), lo, hi
+
+
+def udm_tile(rows, radius, radii):
+
+    points = shared['block_points'][rows]
+    local, _, _ = window(points, radius)
+
+    tree = cKDTree(shared['coords'][local])
+    weights = { g : shared[g][local] for g in udm.groups }
+
+    if radii is not None:
+        return rows, udm.udm_sweep(tree, shared['codes'][local], weights, points, radii)
+
+    return rows, udm.udm_entropies(tree, shared['codes'][local], weights, points, radius)
+
+
+def opd_tile(rows, halo):
+
+    points = shared['coords'][rows]
+    local, lo, hi = window(points, halo)
+
+    tree = cKDTree(shared['coords'][local])
+    sums, radius, reached = pop_knn.neighborhood_sums(tree, shared['weights'][local], shared['block_codes'][local], shared['block_totals'], points, shared['targets'][rows])
+
+    #A neighbourhood is exact only if it closes before the nearest edge of the halo box
+    edge = np.minimum.reduce([points[:, 0] - lo[0], hi[0] - points[:, 0], points[:, 1] - lo[1], hi[1] - points[:, 1]])
+    resolved = reached & (radius < edge)
+
+    return rows, sums, resolved
+
+
+def run_tiles(task, arrays, tasks, processes):
+
+    segments, specs = share(arrays)
+    try:
+        #Workers get everything through shared memory, so they work under any start method
+        with ProcessPoolExecutor(max_workers = processes, initializer = attach, initargs = (specs,)) as pool:
+            for result in pool.map(task, *zip(*tasks)):
+                yield result
+    finally:
+        release(segments)
+
+
+def centroid_arrays(coords):
+
+    x_order = np.argsort(coords[:, 0], kind = 'stable')
+
+    return { 'coords' : coords, 'x_order' : x_order, 'x_sorted' : coords[x_order, 0] }
+
+
+def tiled_udm(coords, codes, weights, points, radius, processes, tile_size, radii = None):
+
+    #With radii, a udm.udm_sweep per tile (radius is then the largest of them) and { radius : { group : entropies } }
+    arrays = centroid_arrays(coords)
+    arrays.update({ 'codes' : codes, 'block_points' : points })
+    arrays.update({ g : weights[g] for g in udm.groups })
+
+    sweep = np.sort(np.asarray(radii, dtype = float)) if radii is not None else [None]
+
+    entropies = { r : { g : np.zeros(len(points)) for g in udm.groups } for r in sweep }
+    tasks = [(rows, radius, radii) for rows in tiles(points, tile_size)]
+
+    for rows, tile_entropies in run_tiles(udm_tile, arrays, tasks, processes):
+        for r in sweep:
+            for g in udm.groups:
+                entropies[r][g][rows] = (tile_entropies[r] if radii is not None else tile_entropies)[g]
+
+    return entropies if radii is not None else entropies[None]
+
+
+def opd_halo(coords, weights, targets):
+
+    #Radius of a disk holding the largest target at the average density, with some slack
+    extent = coords.max(axis = 0) - coords.min(axis = 0)
+    density = weights.sum() / max(extent[0] * extent[1], 1)
+    target = np.nanmax(targets) if np.isfinite(targets).any() else 0
+
+    return 1.5 * np.sqrt(target / max(density, 1e-12) / np.pi)
+
+
+def tiled_opd(tree, coords, weights, block_codes, block_totals, targets, processes, tile_size, halo = None):
+
+    if halo is None:
+        halo = opd_halo(coords, weights, targets)
+
+    arrays = centroid_arrays(coords)
+    arrays.update({ 'weights' : weights, 'block_codes' : block_codes, 'block_totals' : block_totals, 'targets' : targets })
+
+    sums = np.zeros((len(coords), block_totals.shape[1]))
+    resolved = np.zeros(len(coords), dtype = bool)
+    tasks = [(rows, halo) for rows in tiles(coords, tile_size)]
+
+    for rows, tile_sums, tile_resolved in run_tiles(opd_tile, arrays, tasks, processes):
+        sums[rows] = tile_sums
+        resolved[rows] = tile_resolved
+
+    #Neighbourhoods that ran past their halo are redone against the full tree
+    reached = resolved.copy()
+    rerun = np.flatnonzero(~resolved)
+    if len(rerun) > 0:
+        rerun_sums, _, rerun_reached = pop_knn.neighborhood_sums(tree, weights, block_codes, block_totals, coords[rerun], targets[rerun])
+        sums[rerun] = rerun_sums
+        reached[rerun] = rerun_reached
+
+    return sums, reached
@@ -0,0 +1,92 @@
+import os, sys
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import sparse_entropy
+
+#Uncertainty of district membership (UDM) without expanding blocks into individual voters.
+#A batched ball query gives a sparse (query point x centroid) neighbour matrix; multiplying it by a sparse
+#(centroid x district) matrix of voter counts gives voters per district around each point, and the entropy follows.
+
+groups = ['dem_udm', 'rep_udm', 'nw_udm']
+
+def group_weights(centroids):
+
+    values = centroids[['ALL', 'W', 'DEM', 'REP']].fillna(0)
+
+    #Whole voters only, as the per-voter expansion this replaces used int()
+    return {
+        'dem_udm' : np.trunc(values['DEM'].to_numpy()),
+        'rep_udm' : np.trunc(values['REP'].to_numpy()),
+        'nw_udm' : np.clip(np.trunc(values['ALL'].to_numpy()) - np.trunc(values['W'].to_numpy()), 0, None),
+    }
+
+
+def district_codes(centroids):
+
+    codes, districts = pd.factorize(centroids['district'].fillna(0))
+
+    return codes, districts
+
+
+def district_matrix(codes, weights, n_districts):
+
+    return sp.csr_matrix((weights, (np.arange(len(codes)), codes)), shape = (len(codes), n_districts))
+
+
+def neighbor_matrix(hits, n_points):
+
+    lengths = np.array([len(h) for h in hits], dtype = np.int64)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    indices = np.concatenate([np.asarray(h, dtype = np.int64) for h in hits]) if indptr[-1] > 0 else np.zeros(0, dtype = np.int64)
+
+    return sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape = (len(hits), n_points))
+
+
+def udm_entropies(tree, codes, weights, points, radius, batch_size = 10000):
+
+    n_districts = codes.max() + 1 if len(codes) > 0 else 0
+    matrices = { g : district_matrix(codes, w, n_districts) for g, w in weights.items() }
+
+    entropies = { g : np.zeros(len(points)) for g in weights }
+    for start in range(0, len(points), batch_size):
+        hits = tree.query_ball_point(points[start:start + batch_size], radius)
+        neighbors = neighbor_matrix(hits, tree.n)
+
+        for g, matrix in matrices.items():
+            entropies[g][start:start + len(hits)] = sparse_entropy.entropy(neighbors @ matrix)
+
+    return entropies
+
+
+def udm_sweep(tree, codes, weights, points, radii, batch_size = 10000):
+
+    #UDM at several radii from one ball query at the largest. Each neighbour falls in the ring between two consecutive
+    #radii, and the counts at a radius are the running sum of the rings inside it, so every pair is counted once.
+    #Returns { radius : { group : entropies } }.
+    radii = np.sort(np.asarray(radii, dtype = float))
+
+    n_districts = codes.max() + 1 if len(codes) > 0 else 0
+    matrices = { g : district_matrix(codes, w, n_districts) for g, w in weights.items() }
+
+    entropies = { r : { g : np.zeros(len(points)) for g in weights } for r in radii }
+    for start in range(0, len(points), batch_size):
+        batch = points[start:start + batch_size]
+        neighbors = neighbor_matrix(tree.query_ball_point(batch, radii[-1]), tree.n)
+
+        rows = np.repeat(np.arange(len(batch)), np.diff(neighbors.indptr))
+        distances = ((tree.data[neighbors.indices] - batch[rows]) ** 2).sum(axis = 1)
+        ring = np.searchsorted(radii ** 2, distances, side = 'left')
+
+        counts = { g : sp.csr_matrix((len(batch), n_districts)) for g in matrices }
+        for k, r in enumerate(radii):
+            inside = ring == k
+            ring_neighbors = sp.csr_matrix((np.ones(inside.sum()), (rows[inside], neighbors.indices[inside])), shape = neighbors.shape)
+
+            for g, matrix in matrices.items():
+                counts[g] = counts[g] + ring_neighbors @ matrix
+                entropies[r][g][start:start + len(batch)] = sparse_entropy.entropy(counts[g])
+
+    return entropies
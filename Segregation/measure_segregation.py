@@ -1,13 +1,18 @@
 import os, sys
-import geopandas as gpd
 import pandas as pd
-from tqdm import tqdm
 import argparse
-from statistics import mean
 from scipy.spatial import cKDTree
-import segregation
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import vr_store
+import adjacency
+import pop_knn
+import geometry_cache
+import instrumentation
+
+import spatial_dissim
+
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -20,11 +25,25 @@ parser.add_argument('-z', '--zctas', type = str, help = 'A shapefile of ZCTAs')
 parser.add_argument('-d', '--districts', type = str, help = 'A shapefile of legislative districts.')
 parser.add_argument('-p', '--precincts', type = str, help = 'A shapefile of precincts')
 parser.add_argument('-v', '--voters', type = str, help = 'Precinct-level voter registration data with party, ethnicity, and race')
+parser.add_argument('--vr_store', type = str, help = 'Snapshot directory of the Parquet voter store (read instead of --voters)')
+parser.add_argument('--counties', type = str, nargs = '+', help = 'Only read these counties (county_desc) from --vr_store')
+parser.add_argument('--zcta_list', type = str, default = 'NCRawData/NC_2022_ZCTAs.csv', help = 'A file of ZCTA GISJOINs to measure, one per line')
+parser.add_argument('--district_population', type = int, default = 200000, help = 'Voters in the neighbourhood around each ZCTA')
+parser.add_argument('-o', '--output', type = str, default = 'ZCTA_seg_test.shp', help = 'Output shapefile')
 
 args = parser.parse_args()
 
-precincts = gpd.read_file(args.precincts)
-voters = pd.read_csv(args.voters)
+instrumentation.start(__file__, args)
+
+instrumentation.step('load')
+precincts = geometry_cache.load(args.precincts)
+precincts['prec_id'] = vr_store.pad_precinct(precincts['prec_id'])
+
+if args.vr_store:
+    voters = vr_store.precinct_counts(args.vr_store, args.counties)
+else:
+    voters = pd.read_csv(args.voters)
+    voters['precinct_abbrv'] = vr_store.pad_precinct(voters['precinct_abbrv'])
 
 precincts_long = pd.merge(precincts, voters, left_on = ['county_nam', 'prec_id'], right_on = ['county_desc', 'precinct_abbrv'])
 
@@ -38,51 +57,35 @@ precincts = pd.merge(precincts, total, on = ['county_nam', 'prec_id'])
 precincts['NW'] = precincts['ALL'] - precincts['W']
 precincts['uniqid'] = [i for i in range(precincts.shape[0])]
 
-print(precincts.shape[0])
-
-centroids = precincts.copy(); centroids.geometry = precincts.geometry.centroid
-pw_centroids = pd.DataFrame()
-pw_centroids['uniqid'] = centroids['uniqid'].repeat(centroids['ALL'])
-pw_centroids['geometry'] = centroids['geometry'].repeat(centroids['ALL'])
-pw_centroid_tree = cKDTree(np.array(list(pw_centroids.geometry.apply(lambda x: (x.x, x.y)))))
-
-zctas = gpd.read_file(args.zctas).to_crs('ESRI:102003')
-zctas = zctas[zctas['GISJOIN'].isin([l.strip() for l in open('NCRawData/NC_2022_ZCTAs.csv')])]
-
-district_population = 200000
-
-party_dissim = []; race_dissim = []
-for _, zcta in tqdm(zctas.iterrows(), total = zctas.shape[0]):
-
-    dist, idx = pw_centroid_tree.query((zcta.geometry.centroid.x, zcta.geometry.centroid.y), district_population)
-    knn = list(dict.fromkeys(pd.DataFrame(pw_centroids.iloc[idx])['uniqid'].tolist()))
-    knn_precincts = precincts[precincts['uniqid'].isin(knn)]
-    
-    print(knn_precincts.shape[0], sum(knn_precincts['ALL'].tolist()))
-
-    party_spatial_index = segregation.singlegroup.SpatialDissim(knn_precincts, 'DEM', 'ALL')
-    race_spatial_index = segregation.singlegroup.SpatialDissim(knn_precincts, 'NW', 'ALL')
-
-    party_dissim.append(party_spatial_index.statistic)
-    race_dissim.append(race_spatial_index.statistic)
-
-zctas['party_dissim'] = party_dissim
-zctas['race_dissim'] = race_dissim
-
-zctas.to_file('ZCTA_seg_test.shp')
-
-
-
-
-
-
-
-
+instrumentation.rows('precincts', precincts.shape[0])
 
+instrumentation.step('contiguity')
+centroids = precincts.geometry.centroid
+centroid_tree = cKDTree(np.column_stack([centroids.x, centroids.y]))
 
+#Queen contiguity of the whole layer, built once; each neighbourhood's weights are read from it
+contiguity = adjacency.queen(precincts.geometry.values)
 
+instrumentation.step('neighborhoods')
+zctas = geometry_cache.load(args.zctas)
+zctas = zctas[zctas['GISJOIN'].isin([l.strip() for l in open(args.zcta_list)])]
+instrumentation.rows('zctas', zctas.shape[0])
 
+#The nearest precincts holding district_population voters, as the tree of one point per voter found them
+zcta_centroids = zctas.geometry.centroid
+targets = np.full(zctas.shape[0], args.district_population, dtype = float)
+neighborhoods = pop_knn.neighborhoods(centroid_tree, precincts['ALL'].to_numpy(dtype = float), np.column_stack([zcta_centroids.x, zcta_centroids.y]), targets)
 
+unreached = sum(h is None for h in neighborhoods)
+instrumentation.failure('zctas_unreached', unreached)
+if unreached > 0:
+    print(str(unreached) + ' ZCTAs left empty: fewer than ' + str(args.district_population) + ' voters in all precincts')
 
+instrumentation.step('dissimilarity')
+members = spatial_dissim.membership(neighborhoods, precincts.shape[0])
 
+_, zctas['party_dissim'] = spatial_dissim.spatial_dissim(members, contiguity, precincts['DEM'].to_numpy(dtype = float), precincts['ALL'].to_numpy(dtype = float))
+_, zctas['race_dissim'] = spatial_dissim.spatial_dissim(members, contiguity, precincts['NW'].to_numpy(dtype = float), precincts['ALL'].to_numpy(dtype = float))
 
+instrumentation.step('write')
+zctas.to_file(args.output)
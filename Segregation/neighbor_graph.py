@@ -0,0 +1,53 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
+
+#Neighbour structures for one simulated electorate, found once and shared by the opinion dynamics and every metric.
+#Each graph is a sparse (voter x voter) 0/1 CSR matrix, so a row's neighbours are indices[indptr[i]:indptr[i + 1]]
+#and neighbourhood counts are a single matrix-vector product.
+#
+#  knn:  the n_neighbors nearest voters (opinion dynamics), for the whole electorate
+#  ball: every voter within radius (UDM and party max-p), in batches of rows, as a statewide electorate's balls
+#        hold thousands of voters each and do not fit in memory at once
+#
+#Every neighbourhood includes the voter itself. Partisan dislocation, whose neighbourhoods are district-sized, has
+#its own engine in partisan_dislocation.
+
+def csr(lengths, indices, n):
+
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    return sp.csr_matrix((np.ones(len(indices), dtype = np.int8), indices, indptr), shape = (len(lengths), n))
+
+
+def knn_graph(tree, coords, k):
+
+    _, idx = tree.query(coords, k)
+    idx = idx.reshape(len(coords), -1)
+
+    return csr(np.full(len(coords), idx.shape[1]), idx.ravel(), tree.n)
+
+
+def ball_graph(tree, coords, radius):
+
+    hits = tree.query_ball_point(coords, radius)
+
+    lengths = np.array([len(h) for h in hits], dtype = np.int64)
+    indices = np.concatenate([np.asarray(h, dtype = np.int64) for h in hits]) if lengths.sum() > 0 else np.zeros(0, dtype = np.int64)
+
+    return csr(lengths, indices, tree.n)
+
+
+def ball_batches(tree, coords, radius, batch_size = 1000):
+
+    #Yields (start, graph) where graph holds the balls of coords[start:start + batch_size]
+    for start in range(0, len(coords), batch_size):
+        yield start, ball_graph(tree, coords[start:start + batch_size], radius)
+
+
+def fixed_neighbors(graph):
+
+    #Neighbour indexes of a graph with the same number of neighbours per row, as an (n x k) array
+    k = graph.indptr[1] - graph.indptr[0] if graph.shape[0] > 0 else 0
+
+    return graph.indices.reshape(graph.shape[0], k)
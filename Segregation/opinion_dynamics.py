@@ -0,0 +1,51 @@
+import numpy as np
+
+#Neighbour-majority opinion dynamics on simulated voters. Party is an integer array (0 = red, 1 = blue) and the
+#k nearest neighbours of every voter are found once, as an (n x k) index array (neighbor_graph.fixed_neighbors),
+#before any opinions change.
+#
+#  sequential:  voters update one at a time in the given order, each seeing the updates made before it
+#               (the original row-by-row loop over a shuffled voter table)
+#  synchronous: every voter updates at once from the opinions at the start of the step
+
+modes = ['sequential', 'synchronous']
+
+def decide(prop_blue, party, threshold):
+
+    return np.where(prop_blue > 0.5 + threshold, 1, np.where(prop_blue < 0.5 - threshold, 0, party))
+
+
+def sequential(party, neighbors, threshold, order = None):
+
+    #Each voter reads the updates of the voters before it, so this stays a loop. Updating in dependency waves (every
+    #voter whose earlier neighbours are done, at once) gives the same result but measured ~4x slower at 500k voters:
+    #there are only ~50 waves, and building the dependency edges costs more than the loop's few microseconds a voter.
+    party = party.copy()
+    n_neighbors = neighbors.shape[1]
+
+    for i in (range(len(party)) if order is None else order):
+        prop_blue = party[neighbors[i]].sum() / n_neighbors
+
+        if prop_blue > 0.5 + threshold:
+            party[i] = 1
+        elif prop_blue < 0.5 - threshold:
+            party[i] = 0
+
+    return party
+
+
+def synchronous(party, neighbors, threshold):
+
+    prop_blue = party[neighbors].sum(axis = 1) / neighbors.shape[1]
+
+    return decide(prop_blue, party, threshold).astype(party.dtype)
+
+
+def change_minds(party, neighbors, threshold, mode = 'sequential', order = None):
+
+    if mode == 'sequential':
+        return sequential(party, neighbors, threshold, order)
+    elif mode == 'synchronous':
+        return synchronous(party, neighbors, threshold)
+
+    raise ValueError('Unknown opinion dynamics mode: ' + str(mode))
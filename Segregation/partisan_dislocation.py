@@ -0,0 +1,121 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+#Partisan dislocation (PD) of simulated voters: |share blue in the voter's district - share blue among the k voters
+#nearest to them|, with k the district's voter count. party is an integer array (0 = red, 1 = blue) and
+#district_codes are 0..n_districts - 1. District sizes and shares are found once.
+#
+#  exact:       one batched k-nearest query per district, sized to a memory budget. Every voter still sorts its own
+#               k = district size neighbours, so time is O(N x k): fine for a few thousand voters per district, far too
+#               slow for 100k+ (no neighbour list is shared between voters)
+#  approximate: exact neighbourhoods only at sampled anchor voters; every other voter takes the share of its nearest
+#               anchor in the same district. A voter at distance delta from its anchor (whose k-nearest radius is r)
+#               has a k-nearest radius within delta of r, so its neighbourhood contains every voter within r - 2 delta
+#               of the anchor and lies within r + 2 delta of it. Counting blue voters in that annulus around the
+#               anchor bounds the voter's share, and so its PD, without querying it. Costs one k-nearest query per
+#               anchor, so this is the mode for large electorates
+#  auto:        exact up to exact_limit voters per district, approximate above
+
+modes = ['auto', 'exact', 'approximate']
+
+exact_limit = 5000
+
+def choose_mode(mode, district_size, limit = exact_limit):
+
+    if mode == 'auto':
+        return 'exact' if district_size <= limit else 'approximate'
+
+    return mode
+
+
+def district_totals(party, district_codes):
+
+    sizes = np.bincount(district_codes)
+    blue = np.bincount(district_codes, weights = party, minlength = len(sizes))
+
+    return sizes, blue / np.maximum(sizes, 1)
+
+
+def exact(tree, coords, party, district_codes, budget = 20000000):
+
+    sizes, district_prop_blue = district_totals(party, district_codes)
+
+    nearest_blue = np.zeros(len(coords))
+    for d in np.flatnonzero(sizes):
+        rows = np.flatnonzero(district_codes == d); k = sizes[d]
+        step = max(1, budget // k)
+
+        for start in range(0, len(rows), step):
+            batch = rows[start:start + step]
+            _, idx = tree.query(coords[batch], k)
+
+            nearest_blue[batch] = party[idx.reshape(len(batch), -1)].sum(axis = 1)
+
+    return np.abs(district_prop_blue[district_codes] - nearest_blue / sizes[district_codes])
+
+
+def anchor_bounds(tree, center, party, k, deltas):
+
+    #Exact blue count around an anchor, and bounds on the blue count of voters deltas away from it
+    dist, idx = tree.query(center, k)
+    dist = np.atleast_1d(dist); idx = np.atleast_1d(idx)
+
+    radius = dist[-1]
+    anchor_blue = party[idx].sum()
+
+    ball = np.asarray(tree.query_ball_point(center, radius + 2 * deltas.max()), dtype = np.int64)
+    ball_dist = np.sqrt(((tree.data[ball] - center)**2).sum(axis = 1))
+
+    order = np.argsort(ball_dist, kind = 'stable')
+    sorted_dist = ball_dist[order]
+    cum_blue = np.concatenate([[0], np.cumsum(party[ball][order])])
+
+    inner = np.searchsorted(sorted_dist, radius - 2 * deltas, side = 'left')
+    outer = np.searchsorted(sorted_dist, radius + 2 * deltas, side = 'right')
+
+    inner_blue = cum_blue[inner]
+    annulus_blue = cum_blue[outer] - inner_blue
+    annulus_red = (outer - inner) - annulus_blue
+    rest = np.clip(k - inner, 0, None)
+
+    lower = inner_blue + np.clip(rest - annulus_red, 0, None)
+    upper = inner_blue + np.minimum(rest, annulus_blue)
+
+    return anchor_blue, lower, upper
+
+
+def approximate(tree, coords, party, district_codes, anchors_per_district = 200, rng = np.random):
+
+    #PD per voter and a per-voter bound on its error
+    sizes, district_prop_blue = district_totals(party, district_codes)
+
+    nearest_prop_blue = np.zeros(len(coords)); bound = np.zeros(len(coords))
+    for d in np.flatnonzero(sizes):
+        rows = np.flatnonzero(district_codes == d); k = sizes[d]
+
+        anchors = rows[rng.choice(len(rows), min(anchors_per_district, len(rows)), replace = False)]
+        deltas, nearest = cKDTree(coords[anchors]).query(coords[rows])
+
+        for a in np.unique(nearest):
+            members = nearest == a
+
+            anchor_blue, lower, upper = anchor_bounds(tree, coords[anchors[a]], party, k, deltas[members])
+
+            nearest_prop_blue[rows[members]] = anchor_blue / k
+            bound[rows[members]] = np.maximum(anchor_blue - lower, upper - anchor_blue) / k
+
+    return np.abs(district_prop_blue[district_codes] - nearest_prop_blue), bound
+
+
+def partisan_dislocation(tree, coords, party, district_codes, mode = 'exact', anchors_per_district = 200, rng = np.random):
+
+    #PD per voter and its error bound (zero in exact mode)
+    mode = choose_mode(mode, np.bincount(district_codes).max() if len(district_codes) > 0 else 0)
+
+    if mode == 'exact':
+        pd_ = exact(tree, coords, party, district_codes)
+        return pd_, np.zeros(len(pd_))
+    elif mode == 'approximate':
+        return approximate(tree, coords, party, district_codes, anchors_per_district, rng)
+
+    raise ValueError('Unknown partisan dislocation mode: ' + str(mode))
@@ -1,15 +1,22 @@
 import os, sys
+import json
 import geopandas as gpd
 import pandas as pd
 from tqdm import tqdm
 import argparse
-from statistics import mean
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from scipy.spatial import cKDTree
 import numpy as np
-from pointpats import PoissonPointProcess, PoissonClusterPointProcess, Window, poly_from_bbox, PointPattern
-import libpysal as ps
-from libpysal.cg import shapely_ext
+
+import opinion_dynamics
+import neighbor_graph
+import simulation_metrics
+import partisan_dislocation
+import voter_placement
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import geometry_cache
+import instrumentation
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -17,116 +24,160 @@ warnings.filterwarnings("ignore")
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.max_rows', 10000)
 
-voters_per_district = 1000
-n_neighbors = 25
+def threshold(value):
+
+	#Thresholds seed each task's random stream, which needs them non-negative
+	value = float(value)
+	if value < 0:
+		raise argparse.ArgumentTypeError('thresholds must be 0 or more, got ' + str(value))
+
+	return value
+
+
+parser = argparse.ArgumentParser('Simulate voters in legislative districts and measure segregation as they sort')
+
+parser.add_argument('districts', type = str, help = 'A shapefile of legislative districts (with a DISTRICT column).')
+parser.add_argument('--blocks', type = str, help = 'A shapefile of census blocks; voters are then placed in proportion to block population instead of uniformly.')
+parser.add_argument('--pop_var', type = str, default = 'ALL', help = 'The population variable (column name) in the blocks file.')
+parser.add_argument('-t', '--thresholds', type = threshold, nargs = '+', default = [0, 0.05, 0.1, 0.15, 0.2], help = 'Change-of-mind thresholds to sweep (0 or more).')
+parser.add_argument('-i', '--iterations', type = int, default = 100, help = 'Simulated electorates per threshold.')
+parser.add_argument('--voters_per_district', type = int, default = 1000, help = 'Voters placed in each district.')
+parser.add_argument('--n_neighbors', type = int, default = 25, help = 'Neighbours each voter listens to when changing their mind.')
+parser.add_argument('--dynamics', type = str, default = 'sequential', choices = opinion_dynamics.modes, help = 'sequential: voters update one by one in shuffled order; synchronous: everyone updates at once.')
+parser.add_argument('--pd_mode', type = str, default = 'auto', choices = partisan_dislocation.modes, help = 'exact: every voter\'s own k-nearest query, O(voters x district size). approximate: exact neighbourhoods only at --pd_anchors sampled voters per district, with an error bound (written as PD_BOUND). auto: exact up to --pd_exact_limit voters per district.')
+parser.add_argument('--pd_exact_limit', type = int, default = partisan_dislocation.exact_limit, help = 'Largest --voters_per_district that --pd_mode auto runs exactly.')
+parser.add_argument('--pd_anchors', type = int, default = 200, help = 'Anchor voters per district for approximate PD.')
+parser.add_argument('--seed', type = int, default = 0, help = 'Base seed; each (threshold, iteration) task draws from its own stream derived from it.')
+parser.add_argument('-n', '--processes', type = int, default = 1, help = 'Number of tasks to run in parallel.')
+parser.add_argument('-o', '--output', type = str, default = 'MetricsByThreshold.csv', help = 'Output csv; finished tasks are appended, and tasks already in it are skipped.')
+
+#Parameters that change the results; a sweep only resumes from a csv written with the same ones
+resume_parameters = ['districts', 'blocks', 'pop_var', 'voters_per_district', 'n_neighbors', 'dynamics', 'pd_mode', 'pd_anchors', 'seed']
+
+#Set in the main process, and in each pool worker by init_worker
+args = None; sldus = None; blocks = None
+
+def init_worker(worker_args, worker_sldus, worker_blocks):
+
+	#Workers receive the parsed arguments and loaded layers once instead of re-reading the shapefiles
+	global args, sldus, blocks
+	args, sldus, blocks = worker_args, worker_sldus, worker_blocks
+
+
+def simulate(change_mind_threshold, iteration):
+
+	#Same seed, threshold and iteration give the same electorate, whichever process runs it and in whatever order
+	rng = np.random.default_rng(np.random.SeedSequence(args.seed, spawn_key = (int(round(change_mind_threshold * 1000000)), iteration)))
+
+	voters = voter_placement.place_voters(sldus, args.voters_per_district, blocks, args.pop_var, rng)
 
-iterations = 100
+	#Every one makes a random decision (0 = red, 1 = blue)
+	voters['party'] = rng.choice(2, voters.shape[0])
+	voters = voters.sample(frac=1, random_state=rng).reset_index(drop=True)
 
-blue = '#0000FF'
-red = '#FF0000'
+	#Built after the shuffle so tree indexes are row positions in voters
+	voters_coords = np.column_stack([voters.geometry.x, voters.geometry.y])
+	voters_tree = cKDTree(voters_coords)
+	district_codes, _ = pd.factorize(voters['DISTRICT'])
 
-sldus = gpd.read_file(sys.argv[1]).to_crs('ESRI:102003')
+	#kNN neighbourhoods for the dynamics, found once for this electorate
+	neighbors = neighbor_graph.fixed_neighbors(neighbor_graph.knn_graph(voters_tree, voters_coords, args.n_neighbors))
 
-threshes = [0, 0.05, 0.1, 0.15, 0.2]
+	#Now they start changing their minds based on what their neighbors think
+	party = opinion_dynamics.change_minds(voters['party'].to_numpy(), neighbors, change_mind_threshold, args.dynamics)
 
-pds = { thresh : [] for thresh in threshes }; udms = { thresh : [] for thresh in threshes }; party_maxps = { thresh : [] for thresh in threshes }
-for change_mind_threshold in threshes:
+	pd_, pd_bound = partisan_dislocation.partisan_dislocation(voters_tree, voters_coords, party, district_codes, args.pd_mode, args.pd_anchors, rng)
 
-	print('\n\n===================\n\nTHRESHOLD: ' + str(change_mind_threshold) + '\n\n===================\n\n')
+	#UDM and party max-p share one batched ball query
+	udm_, pmp = simulation_metrics.ball_metrics(voters_tree, voters_coords, 5000, party, district_codes)
 
-	for i in tqdm(range(iterations)):
+	metrics = {
+		'PD' : pd_.mean(),
+		'UDM' : udm_.mean(),
+		'PMP' : pmp.mean(),
+	}
 
-		print('Generating voters...')
+	if args.pd_mode == 'approximate':
+		metrics['PD_BOUND'] = pd_bound.mean()
 
-		voters = gpd.GeoDataFrame()
-		#for _, sldu in tqdm(sldus.iterrows(), total = sldus.shape[0]):
-		for _, sldu in sldus.iterrows():
-			sldu_gdf = gpd.GeoDataFrame(geometry = gpd.GeoSeries(sldu.geometry))
-			x_min, y_min, x_max, y_max = sldu_gdf.total_bounds
+	return change_mind_threshold, iteration, metrics
 
-			x = np.random.uniform(x_min, x_max, voters_per_district)
-			y = np.random.uniform(y_min, y_max, voters_per_district)
 
-			district_voters = gpd.GeoSeries(gpd.points_from_xy(x, y))
-			district_voters = district_voters[district_voters.within(sldu_gdf.unary_union)]
-			district_voters =  gpd.GeoDataFrame(geometry = district_voters)
-			district_voters['DISTRICT'] = sldu['DISTRICT']
-			voters = pd.concat([voters, district_voters])
+def parameters_path(path):
 
-		print('Assigning party...')
+	return os.path.splitext(path)[0] + '_parameters.json'
 
-		#Every one makes a random decision
-		voters['party'] = np.random.choice([red, blue], voters.shape[0])
-		voters_tree = cKDTree(np.array(list(voters.geometry.apply(lambda x: (x.x, x.y)))))
-		voters = voters.sample(frac=1).reset_index(drop=True)
 
-		#Now they start changing their minds based on what their neighbors think
-		#for idx, voter in tqdm(voters.iterrows(), total = voters.shape[0]):
-		for idx, voter in voters.iterrows():
-			_, voter_idxs = voters_tree.query((voter.geometry.x, voter.geometry.y), n_neighbors)
-			nearest_voters = voters.iloc[voter_idxs]
+def check_parameters(path):
 
-			prop_blue = nearest_voters[nearest_voters['party'] == blue].shape[0]/n_neighbors
+	parameters = { k : vars(args)[k] for k in resume_parameters }
 
-			if prop_blue > 0.5 + change_mind_threshold:
-				voters.loc[idx, 'party'] = blue
-			elif prop_blue < 0.5 - change_mind_threshold:
-				voters.loc[idx, 'party'] = red
+	if os.path.exists(parameters_path(path)):
+		with open(parameters_path(path)) as f:
+			written = json.load(f)
 
-		print('Calculating partisan dislocation...')
+		changed = [k for k in resume_parameters if written.get(k) != parameters[k]]
+		if len(changed) > 0:
+			parser.error(path + ' was written with different ' + ', '.join(changed) + ' (see ' + parameters_path(path) + '); rerun with the same parameters or another --output')
+	elif os.path.exists(path):
+		parser.error(path + ' has no ' + parameters_path(path) + ', so the parameters that wrote it are unknown; use another --output')
+	else:
+		with open(parameters_path(path), 'w') as f:
+			json.dump(parameters, f, indent = 2)
 
-		pd_ = []
-		#for _, voter in tqdm(voters.iterrows(), total = voters.shape[0]):
-		for _, voter in voters.iterrows():
 
-			district_voters = voters[voters['DISTRICT'] == voter['DISTRICT']]
+def completed(path):
 
-			district_prop_blue = district_voters[district_voters['party'] == blue].shape[0]/district_voters.shape[0]
+	#(threshold, iteration) tasks with every metric already written
+	if not os.path.exists(path):
+		return set()
 
-			_, voter_idxs = voters_tree.query((voter.geometry.x, voter.geometry.y), district_voters.shape[0])
-			nearest_voters = voters.iloc[voter_idxs]
+	done = pd.read_csv(path, on_bad_lines = 'skip')
+	if 'Iteration' not in done.columns:
+		parser.error(path + ' has no Iteration column; it was not written by this sweep')
 
-			nearest_prop_blue = nearest_voters[nearest_voters['party'] == blue].shape[0]/district_voters.shape[0]
+	n_metrics = 4 if args.pd_mode == 'approximate' else 3
+	counts = done.groupby([done['Threshold'].round(9), 'Iteration'])['Metric'].nunique()
 
-			pd_.append(abs(district_prop_blue - nearest_prop_blue))
+	return set(counts.index[counts.to_numpy() >= n_metrics])
 
-		pds[change_mind_threshold].append(mean(pd_))
 
-		print('Calculating uncertainty of district membership...')
+if __name__ == '__main__':
 
-		udm = []; party_maxp = []
-		for _, voter in voters.iterrows():
-		    voter_idxs = voters_tree.query_ball_point((voter.geometry.x, voter.geometry.y), 5000)
-		    nearest_voters = voters.iloc[voter_idxs]
+	args = parser.parse_args()
 
-		    districts = [nearest_voters.iloc[i]['DISTRICT'] for i in range(nearest_voters.shape[0]) if nearest_voters.iloc[i]['party'] == voter['party']]
-		    dists_p = [districts.count(dist)/len(districts) for dist in list(dict.fromkeys(districts))]
-		    dists_e = -sum([pr * np.log2(pr) for pr in dists_p])
-		    udm.append(dists_e)
+	#Every district holds exactly --voters_per_district voters, so auto resolves once for the whole sweep
+	args.pd_mode = partisan_dislocation.choose_mode(args.pd_mode, args.voters_per_district, args.pd_exact_limit)
 
-		    parties = nearest_voters['party'].tolist()
-		    parties_p = [parties.count(p)/len(parties) for p in list(dict.fromkeys(parties))]
-		    party_maxp.append(max(parties_p))
+	instrumentation.start(__file__, args)
 
-		udms[change_mind_threshold].append(mean(udm))
+	instrumentation.step('load')
+	sldus = geometry_cache.load(args.districts)
+	#Stage 2 output changes every run, so it is read directly rather than cached (it is already in the cache CRS)
+	blocks = gpd.read_file(args.blocks) if args.blocks else None
+	instrumentation.rows('districts', sldus.shape[0])
 
-		party_maxps[change_mind_threshold].append(mean(party_maxp))
+	check_parameters(args.output)
 
-with open('MetricsByThreshold.csv', 'w') as o:
-	o.write('Threshold,Metric,Value\n')
+	tasks = [(thresh, i) for thresh in args.thresholds for i in range(args.iterations)]
 
-	for thresh in threshes:
+	done = completed(args.output)
+	tasks = [(thresh, i) for thresh, i in tasks if (round(thresh, 9), i) not in done]
 
-		for pd_ in pds[thresh]:
-			o.write(str(thresh) + ',PD,' + str(pd_) + '\n')
+	print(str(len(done)) + ' tasks already in ' + args.output + ', ' + str(len(tasks)) + ' to run')
 
-		for udm in udms[thresh]:
-			o.write(str(thresh) + ',UDM,' + str(udm) + '\n')
+	instrumentation.step('simulate', tasks = len(tasks), resumed = len(done))
 
-		for pmp in party_maxps[thresh]:
-			o.write(str(thresh) + ',PMP,' + str(pmp) + '\n')
-		
+	if not os.path.exists(args.output):
+		with open(args.output, 'w') as o:
+			o.write('Threshold,Iteration,Metric,Value\n')
 
-		
+	with ProcessPoolExecutor(max_workers = args.processes, initializer = init_worker, initargs = (args, sldus, blocks)) as pool:
+		futures = [pool.submit(simulate, thresh, i) for thresh, i in tasks]
 
+		for future in tqdm(as_completed(futures), total = len(futures)):
+			thresh, i, metrics = future.result()
 
+			#One write per task, so a crash loses at most the tasks still running
+			with open(args.output, 'a') as o:
+				o.write(''.join(str(thresh) + ',' + str(i) + ',' + metric + ',' + str(value) + '\n' for metric, value in metrics.items()))
@@ -0,0 +1,52 @@
+import os, sys
+import numpy as np
+import scipy.sparse as sp
+
+import neighbor_graph
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Utilities'))
+import sparse_entropy
+
+#Per-voter segregation metrics of a simulated electorate as array reductions over the shared neighbour graphs
+#(see neighbor_graph). party is an integer array (0 = red, 1 = blue); district_codes are 0..n_districts - 1.
+#Graphs may hold a batch of rows: row i is the neighbourhood of voter start + i.
+
+def party_districts(party, district_codes):
+
+    #(voter x district) indicators of blue voters and of red voters
+    n = len(party); n_districts = district_codes.max() + 1 if n > 0 else 0
+    blue = party.astype(float)
+
+    return [sp.csr_matrix((mask, (np.arange(n), district_codes)), shape = (n, n_districts)) for mask in [blue, 1 - blue]]
+
+
+def udm(graph, party, members, start = 0):
+
+    #Entropy of the districts of same-party voters within the ball around each voter
+    blue = party[start:start + graph.shape[0]].astype(float)
+
+    counts = [sp.diags(mask) @ (graph @ matrix) for mask, matrix in zip([blue, 1 - blue], members)]
+
+    return sparse_entropy.entropy(counts[0] + counts[1])
+
+
+def party_maxp(graph, party):
+
+    #Share of the larger party within the ball around each voter
+    n_blue = graph @ party.astype(float)
+    n_total = np.diff(graph.indptr)
+
+    return np.maximum(n_blue, n_total - n_blue) / n_total
+
+
+def ball_metrics(tree, coords, radius, party, district_codes, batch_size = 1000):
+
+    #UDM and party max-p of every voter from one ball query per batch, so only a batch of balls is held at a time
+    members = party_districts(party, district_codes)
+
+    udm_values = np.zeros(len(coords)); maxp_values = np.zeros(len(coords))
+    for start, graph in neighbor_graph.ball_batches(tree, coords, radius, batch_size):
+        udm_values[start:start + graph.shape[0]] = udm(graph, party, members, start)
+        maxp_values[start:start + graph.shape[0]] = party_maxp(graph, party)
+
+    return udm_values, maxp_values
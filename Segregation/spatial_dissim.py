@@ -0,0 +1,53 @@
+import numpy as np
+import scipy.sparse as sp
+
+#Dissimilarity (D) and spatial dissimilarity (SD, Morrill 1991) for many neighbourhoods of one layer of units at
+#once, matching segregation.singlegroup.SpatialDissim(data, group, total) with Queen weights and standardize=False
+#run separately on each neighbourhood. Neighbourhoods are the rows of a sparse (neighbourhood x unit) membership
+#matrix; contiguity is the full layer's (unit x unit) 0/1 matrix, so each neighbourhood's weights are the pairs with
+#both units inside it.
+
+def membership(neighborhoods, n_units):
+
+    lengths = np.array([0 if h is None else len(h) for h in neighborhoods], dtype = np.int64)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    indices = np.concatenate([np.asarray(h, dtype = np.int64) for h in neighborhoods if h is not None]) if indptr[-1] > 0 else np.zeros(0, dtype = np.int64)
+
+    return sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape = (len(neighborhoods), n_units))
+
+
+def pair_sums(members, pairs):
+
+    #Sum of pairs[i, j] over i, j both in each neighbourhood
+    return np.asarray((members @ pairs).multiply(members).sum(axis = 1)).ravel()
+
+
+def spatial_dissim(members, contiguity, x, t):
+
+    #D and SD per neighbourhood of group counts x and totals t. Units with a missing x or t are left out, as
+    #SpatialDissim drops them; empty neighbourhoods are NaN.
+    valid = ~(np.isnan(x) | np.isnan(t))
+    x = np.where(valid, x, 0); t = np.where(valid, t, 0)
+
+    members = (members @ sp.diags(valid.astype(float))).tocsr()
+    members.eliminate_zeros()
+
+    pi = np.where(t == 0, 0, x / np.where(t == 0, 1, t))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        T = members @ t
+        P = (members @ x) / T
+
+        rows = np.repeat(np.arange(members.shape[0]), np.diff(members.indptr))
+        cols = members.indices
+        D = np.bincount(rows, weights = t[cols] * np.abs(pi[cols] - P[rows]), minlength = members.shape[0]) / (2 * T * P * (1 - P))
+
+        c = contiguity.tocoo()
+        distances = sp.csr_matrix((np.abs(pi[c.row] - pi[c.col]), (c.row, c.col)), shape = contiguity.shape)
+
+        SD = D - pair_sums(members, distances) / pair_sums(members, contiguity)
+
+    empty = np.diff(members.indptr) == 0
+    D[empty] = np.nan; SD[empty] = np.nan
+
+    return D, SD
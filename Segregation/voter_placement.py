@@ -0,0 +1,113 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+
+#Simulated voter locations: exactly n voters per district, drawn for every district at once.
+#Points are rejection sampled in batches: each round draws, per polygon still short of its count, enough uniform
+#points in its bounding box to cover the shortfall at the polygon's fill rate, and keeps those inside the (prepared)
+#polygon, up to the count. Population-weighted placement first picks a block per voter in proportion to block
+#population, then samples the voter inside that block the same way.
+
+def sample_in(geoms, counts, rng = np.random, oversample = 1.2):
+
+    #x, y and the polygon index of counts[i] uniform points inside each geoms[i], grouped by polygon
+    geoms = np.asarray(geoms); counts = np.asarray(counts, dtype = np.int64)
+    shapely.prepare(geoms)
+
+    bounds = shapely.bounds(geoms)
+    box_area = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+    area = shapely.area(geoms)
+
+    if ((counts > 0) & ~(area > 0)).any():
+        raise ValueError('Cannot place points in ' + str(((counts > 0) & ~(area > 0)).sum()) + ' polygons without area')
+
+    fill = np.clip(area / np.where(box_area > 0, box_area, 1), 0.01, 1)
+
+    xs = []; ys = []; owners = []
+    need = counts.copy()
+    while need.sum() > 0:
+        todo = np.flatnonzero(need > 0)
+        owner = np.repeat(todo, np.ceil(need[todo] / fill[todo] * oversample).astype(np.int64))
+
+        x = rng.uniform(bounds[owner, 0], bounds[owner, 2])
+        y = rng.uniform(bounds[owner, 1], bounds[owner, 3])
+
+        inside = shapely.contains_xy(geoms[owner], x, y)
+        owner = owner[inside]; x = x[inside]; y = y[inside]
+
+        #Keep at most the shortfall of each polygon, in draw order
+        order = np.argsort(owner, kind = 'stable')
+        rank = np.arange(len(owner)) - np.searchsorted(owner[order], owner[order], side = 'left')
+        keep = order[rank < need[owner[order]]]
+        keep.sort()
+
+        xs.append(x[keep]); ys.append(y[keep]); owners.append(owner[keep])
+        need -= np.bincount(owner[keep], minlength = len(need))
+
+    x = np.concatenate(xs) if xs else np.zeros(0); y = np.concatenate(ys) if ys else np.zeros(0)
+    owner = np.concatenate(owners) if owners else np.zeros(0, dtype = np.int64)
+
+    order = np.argsort(owner, kind = 'stable')
+
+    return x[order], y[order], owner[order]
+
+
+def block_districts(blocks, districts):
+
+    #Block -> district positions, by the district holding each block's representative point
+    block_idx, district_idx = districts.sindex.query(blocks.geometry.representative_point().values, predicate = 'within')
+
+    assignment = np.full(blocks.shape[0], -1, dtype = np.int64)
+    assignment[block_idx] = district_idx
+
+    return assignment
+
+
+def population_counts(assignment, population, n_districts, n_per_district, rng = np.random):
+
+    #Voters per block: n_per_district draws per district over its blocks, weighted by population
+    counts = np.zeros(len(assignment), dtype = np.int64)
+    unweighted = []
+
+    for d in range(n_districts):
+        members = np.flatnonzero(assignment == d)
+        pop = population[members]
+
+        if len(members) == 0 or pop.sum() <= 0:
+            unweighted.append(d)
+            continue
+
+        counts += np.bincount(members[rng.choice(len(members), n_per_district, p = pop / pop.sum())], minlength = len(counts))
+
+    return counts, unweighted
+
+
+def place_voters(districts, n_per_district, blocks = None, pop_var = None, rng = np.random):
+
+    #One row per voter with a point geometry and the voter's DISTRICT
+    n_districts = districts.shape[0]
+    counts = np.full(n_districts, n_per_district, dtype = np.int64)
+
+    x = []; y = []; owner = []
+    if blocks is not None:
+        blocks = blocks.to_crs(districts.crs)
+
+        assignment = block_districts(blocks, districts)
+        block_counts, unweighted = population_counts(assignment, blocks[pop_var].fillna(0).to_numpy(dtype = float), n_districts, n_per_district, rng)
+
+        if len(unweighted) > 0:
+            print('No block population for ' + str(len(unweighted)) + ' districts; placing their voters uniformly')
+
+        bx, by, block_owner = sample_in(blocks.geometry.values, block_counts, rng)
+        x.append(bx); y.append(by); owner.append(assignment[block_owner])
+
+        counts[:] = 0
+        counts[unweighted] = n_per_district
+
+    dx, dy, district_owner = sample_in(districts.geometry.values, counts, rng)
+    x.append(dx); y.append(dy); owner.append(district_owner)
+
+    x = np.concatenate(x); y = np.concatenate(y); owner = np.concatenate(owner)
+    order = np.argsort(owner, kind = 'stable')
+
+    return gpd.GeoDataFrame({ 'DISTRICT' : districts['DISTRICT'].to_numpy()[owner[order]] }, geometry = gpd.points_from_xy(x[order], y[order]), crs = districts.crs)
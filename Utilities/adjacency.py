@@ -0,0 +1,76 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+import shapely
+
+import block_weights
+
+#Contiguity between polygons, built once for a whole layer as a sparse (unit x unit) 0/1 matrix.
+#Queen contiguity (as libpysal's Queen.from_dataframe) joins units that share at least one vertex: a sparse
+#(unit x vertex) incidence matrix times its transpose counts the vertices each pair shares. The graph of any subset
+#of units is the matching rows and columns of the full matrix.
+#
+#contiguity() is the cached variant for layers read again on every run (precincts): pairs of intersecting polygons and
+#their shared boundary length, found with one spatial index query and kept on disk under a key hashed from the layer's
+#geometry and ids, as block_weights does for overlaps. The predicate is intersects, not the touches that the
+#per-precinct loop it replaced used: precinct layers from different sources overlap by slivers, and touches drops
+#any pair whose interiors overlap at all, so neighbors that overlap slightly were missed. Touching pairs, including
+#corner-only ones, are found as before.
+
+cache_dir = os.path.join('Output', 'adjacency')
+
+def queen(geoms):
+
+    coords, owner = shapely.get_coordinates(np.asarray(geoms), return_index = True)
+    _, vertex = np.unique(coords, axis = 0, return_inverse = True)
+    vertex = vertex.ravel()
+
+    incidence = sp.csr_matrix((np.ones(len(owner)), (owner, vertex)), shape = (len(geoms), vertex.max() + 1 if len(vertex) > 0 else 0))
+    incidence.data[:] = 1
+
+    shared = (incidence @ incidence.T).tocsr()
+    shared.setdiag(0)
+    shared.eliminate_zeros()
+    shared.data[:] = 1
+
+    return shared
+
+
+def boundary_pairs(geoms):
+
+    #Each pair (i < j) of polygons that touch or overlap, with the length of boundary they share. Overlapping slivers
+    #(common between precinct and district sources) count the length of each boundary running inside the other.
+    geoms = np.asarray(geoms)
+
+    i, j = shapely.STRtree(geoms).query(geoms, predicate = 'intersects')
+    keep = i < j
+    i, j = i[keep], j[keep]
+
+    length = (shapely.length(shapely.intersection(shapely.boundary(geoms[i]), geoms[j])) + shapely.length(shapely.intersection(shapely.boundary(geoms[j]), geoms[i]))) / 2
+
+    return i, j, length
+
+
+def contiguity(geoms, ids, directory = None):
+
+    #Symmetric (unit x unit) matrices: 0/1 adjacency and shared boundary length. Units meeting only at a corner are
+    #adjacent with length 0.
+    path = os.path.join(directory or cache_dir, block_weights.layer_key(geoms, ids)[:24] + '.npz')
+
+    if os.path.exists(path):
+        print('Loading adjacency from ' + path)
+        pairs = np.load(path)
+        i, j, length = pairs['i'], pairs['j'], pairs['length']
+    else:
+        i, j, length = boundary_pairs(geoms)
+
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        np.savez_compressed(path, i = i, j = j, length = length)
+
+    rows = np.concatenate([i, j]); cols = np.concatenate([j, i])
+    shape = (len(geoms), len(geoms))
+
+    binary = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape = shape)
+    lengths = sp.csr_matrix((np.concatenate([length, length]), (rows, cols)), shape = shape)
+
+    return binary, lengths
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+#Bulk block -> target overlap fractions from one spatial index query instead of a per-target within/intersects scan.
+#Returns one row per intersecting (block, target) pair: positional block and target indices and the share of block area in the target.
+
+def block_overlaps(blocks, targets, snap = 0.01, keep_zero = False, geometries = False):
+
+    block_geoms = np.asarray(blocks.geometry.values)
+    target_geoms = np.asarray(targets.geometry.values)
+
+    target_idx, block_idx = blocks.sindex.query(target_geoms, predicate = 'intersects')
+
+    #Blocks entirely inside a target need no intersection
+    contained = shapely.within(block_geoms[block_idx], target_geoms[target_idx])
+    boundary = np.flatnonzero(~contained)
+
+    overlap = np.ones(len(block_idx))
+    sect_geoms = np.empty(len(block_idx), dtype = object)
+
+    #Repair each geometry once rather than once per pair
+    repaired_blocks = repair(block_geoms, block_idx if geometries else block_idx[boundary])
+    repaired_targets = repair(target_geoms, target_idx[boundary])
+
+    if geometries:
+        sect_geoms[contained] = repaired_blocks[block_idx[contained]]
+    sect_geoms[boundary] = shapely.intersection(repaired_blocks[block_idx[boundary]], repaired_targets[target_idx[boundary]])
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        overlap[boundary] = shapely.area(sect_geoms[boundary]) / shapely.area(block_geoms[block_idx[boundary]])
+
+    if snap is not None:
+        overlap = np.where(overlap < snap, 0, np.where(overlap > 1 - snap, 1, overlap))
+
+    pairs = pd.DataFrame({ 'block' : block_idx, 'target' : target_idx, 'overlap' : overlap })
+    if geometries:
+        pairs['geometry'] = sect_geoms
+
+    if not keep_zero:
+        pairs = pairs[pairs['overlap'] > 0]
+
+    return pairs.reset_index(drop = True)
+
+
+def repair(geoms, idx):
+
+    #Layers loaded through geometry_cache are already valid, so this only rebuilds what is still broken
+    repaired = np.empty(len(geoms), dtype = object)
+    idx = np.unique(idx)
+    repaired[idx] = geoms[idx]
+
+    invalid = idx[~shapely.is_valid(geoms[idx])]
+    repaired[invalid] = shapely.buffer(geoms[invalid], 0)
+
+    return repaired
@@ -0,0 +1,71 @@
+import os
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+import shapely
+
+import areal_weights
+
+#Block -> target overlap fractions as a sparse (block x target) matrix, computed once per pair of layers and kept on
+#disk. Entry (b, t) is the share of block b's area inside target t (areal_weights.block_overlaps, snapped), so
+#allocating block values to targets is matrix.T @ values. Matrices are cached under a key hashed from both layers'
+#geometry (WKB) and ids and the snap setting, so the overlay is only redone when an input geometry changes.
+#Each cache entry is <key>.npz (the compressed CSR matrix) and <key>_ids.npz (block and target id indexes).
+
+cache_dir = os.path.join('Output', 'block_weights')
+
+def layer_key(geoms, ids):
+
+    h = hashlib.sha1()
+    for wkb in shapely.to_wkb(np.asarray(geoms)):
+        h.update(wkb)
+    h.update('\n'.join(str(i) for i in ids).encode())
+
+    return h.hexdigest()
+
+
+def cache_key(blocks, targets, block_ids, target_ids, snap):
+
+    key = layer_key(blocks.geometry.values, block_ids) + layer_key(targets.geometry.values, target_ids) + str(snap)
+
+    return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+def load(path):
+
+    #The matrix and its block and target id indexes
+    ids = np.load(path[:-len('.npz')] + '_ids.npz')
+
+    return sp.load_npz(path).tocsr(), ids['blocks'], ids['targets']
+
+
+def save(path, matrix, block_ids, target_ids):
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+
+    sp.save_npz(path, matrix, compressed = True)
+    np.savez_compressed(path[:-len('.npz')] + '_ids.npz', blocks = np.asarray(block_ids, dtype = str), targets = np.asarray(target_ids, dtype = str))
+
+
+def overlap_matrix(blocks, targets, block_ids, target_ids, snap = 0.01, directory = None):
+
+    path = os.path.join(directory or cache_dir, cache_key(blocks, targets, block_ids, target_ids, snap) + '.npz')
+
+    if os.path.exists(path) and os.path.exists(path[:-len('.npz')] + '_ids.npz'):
+        print('Loading block weights from ' + path)
+        return load(path)[0]
+
+    pairs = areal_weights.block_overlaps(blocks, targets, snap)
+    matrix = sp.csr_matrix((pairs['overlap'].to_numpy(), (pairs['block'].to_numpy(), pairs['target'].to_numpy())), shape = (blocks.shape[0], targets.shape[0]))
+
+    save(path, matrix, block_ids, target_ids)
+
+    return matrix
+
+
+def pairs(matrix):
+
+    #(block, target, overlap) positional triples of the non-zero entries, ordered by target then block
+    coo = matrix.tocsc().tocoo()
+
+    return coo.row, coo.col, coo.data
@@ -0,0 +1,96 @@
+import os
+import glob
+import hashlib
+import argparse
+import numpy as np
+import geopandas as gpd
+import shapely
+
+#Layers repaired and projected once and kept on disk as GeoParquet, so stages load ready-to-use geometry instead of
+#re-projecting every run and re-repairing polygons inside their overlay loops. A layer is cached under a key hashed
+#from its source file(s) and the target CRS, so editing the shapefile rebuilds it. Loaded layers come back with their
+#geometries prepared (shapely.prepare) and spatial index built, ready for repeated predicate queries.
+#
+#Run directly to build the cache ahead of the pipeline:
+#    python Utilities/geometry_cache.py NCRawData/blocks.shp NCRawData/precincts.shp ...
+
+cache_dir = os.path.join('Output', 'geometry_cache')
+crs = 'ESRI:102003'
+
+def source_files(path):
+
+    #A shapefile is its .shp plus sidecars (.dbf, .prj, ...); other formats (zip, gpkg, parquet) are one file
+    if path.lower().endswith('.shp'):
+        return sorted(glob.glob(path[:-len('.shp')] + '.*'))
+
+    return [path]
+
+
+def source_key(path, to_crs):
+
+    h = hashlib.sha1()
+    for file in source_files(path):
+        h.update(os.path.basename(file).encode())
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(str(to_crs).encode())
+
+    return h.hexdigest()[:24]
+
+
+def repair(geoms):
+
+    #Only invalid geometries are rebuilt; valid ones are left exactly as read
+    geoms = np.asarray(geoms).copy()
+    invalid = ~shapely.is_valid(geoms) & ~shapely.is_missing(geoms)
+    geoms[invalid] = shapely.buffer(geoms[invalid], 0)
+
+    return geoms, int(invalid.sum())
+
+
+def build(path, to_crs = crs, directory = None):
+
+    layer = gpd.read_file(path).to_crs(to_crs)
+
+    geoms, n_repaired = repair(layer.geometry.values)
+    layer = layer.set_geometry(gpd.GeoSeries(geoms, index = layer.index, crs = layer.crs))
+
+    output = os.path.join(directory or cache_dir, source_key(path, to_crs) + '.parquet')
+    os.makedirs(os.path.dirname(output), exist_ok = True)
+
+    #Bounding-box columns let readers filter row groups spatially without decoding geometry
+    layer.to_parquet(output, write_covering_bbox = True)
+
+    print('Cached ' + path + ' (' + str(layer.shape[0]) + ' geometries, ' + str(n_repaired) + ' repaired) to ' + output)
+
+    return output
+
+
+def load(path, to_crs = crs, directory = None):
+
+    cached = os.path.join(directory or cache_dir, source_key(path, to_crs) + '.parquet')
+
+    if not os.path.exists(cached):
+        cached = build(path, to_crs, directory)
+
+    layer = gpd.read_parquet(cached)
+    layer = layer.drop(columns = [c for c in ['bbox'] if c in layer.columns])
+
+    shapely.prepare(np.asarray(layer.geometry.values))
+    layer.sindex  #built now rather than on the first query
+
+    return layer
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Repair and project geometry layers once and cache them for the pipeline stages')
+    parser.add_argument('layers', type = str, nargs = '+', help = 'Shapefiles (or other vector files) to cache')
+    parser.add_argument('--crs', type = str, default = crs, help = 'CRS to project each layer to')
+    parser.add_argument('-o', '--output', type = str, help = 'Cache directory (default ' + cache_dir + ')')
+
+    args = parser.parse_args()
+
+    for path in args.layers:
+        build(path, args.crs, args.output)
@@ -0,0 +1,193 @@
+import os, sys
+import json
+import time
+import atexit
+import socket
+import resource
+import multiprocessing
+from datetime import datetime
+from contextlib import contextmanager
+
+#Per-run instrumentation shared by the pipeline scripts. A script calls start() once after parsing its arguments,
+#marks its work as named phases, records row counts and failure counts as it goes, and gets a JSON report when it
+#exits, whether it finished or crashed. Top-level script code moves from phase to phase with step('overlay'), which
+#ends the previous step; code inside a step or a function can nest with phase('kdtree'): ... Reports go to the path
+#in the RUN_REPORT environment variable if set (the benchmark harness uses this), otherwise to Output/run_reports.
+#
+#Peak memory is sampled at phase boundaries without resetting the kernel's counters, so the process peak (and the
+#ru_maxrss a parent reads on wait) stays whole-run. A phase during which the process high-water mark (VmHWM, or
+#ru_maxrss off Linux) rose gets that new mark as its peak, which is exact; otherwise its peak is the largest RSS sampled
+#at its start, its end or the end of a nested phase, a lower bound. Nested phases fold their samples into the phases
+#around them. Worker processes (process pools) are reported as the peak RSS of the largest child.
+
+report_dir = os.path.join('Output', 'run_reports')
+
+run = None
+open_phases = []
+current_step = None
+last_hwm = 0.0
+
+def hwm_mb():
+
+    #Process high-water mark, from /proc or from rusage where /proc is unavailable
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def rss_mb():
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return None
+
+
+def fold_peak():
+
+    #Credit every open phase with the peak since the last sample: the new high-water mark if it rose, which is
+    #exact, or else the current RSS
+    global last_hwm
+
+    peak = hwm_mb()
+    sample = peak if peak > last_hwm else (rss_mb() or 0.0)
+    for record in open_phases:
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], sample)
+    run['peak_rss_mb'] = max(run['peak_rss_mb'], peak)
+
+    last_hwm = peak
+
+
+def start(script, args = None):
+
+    global run, last_hwm
+
+    #Pool workers started by spawn/forkserver re-run the script's top level; only the parent process reports
+    if run is not None or multiprocessing.parent_process() is not None:
+        return run
+
+    run = {
+        'script' : os.path.basename(script),
+        'argv' : sys.argv[1:],
+        'args' : vars(args) if args is not None else {},
+        'host' : socket.gethostname(),
+        'pid' : os.getpid(),
+        'started' : datetime.now().isoformat(timespec = 'seconds'),
+        'status' : 'running',
+        'phases' : [],
+        'rows' : {},
+        'failures' : {},
+        'peak_rss_mb' : hwm_mb(),
+        'start_time' : time.perf_counter(),
+    }
+
+    last_hwm = run['peak_rss_mb']
+
+    #Record uncaught errors in the report before the interpreter exits
+    default_hook = sys.excepthook
+    def excepthook(kind, value, traceback):
+        run['status'] = 'failed'
+        run['error'] = kind.__name__ + ': ' + str(value)
+        default_hook(kind, value, traceback)
+    sys.excepthook = excepthook
+
+    atexit.register(finish)
+
+    return run
+
+
+@contextmanager
+def phase(name, **rows):
+
+    #Times a named phase; yields its record so callers can add row counts with rows()
+    if run is None:
+        yield {}
+        return
+
+    fold_peak()
+
+    record = { 'name' : '/'.join([r['name'] for r in open_phases] + [name]), 'rows' : { k : int(v) for k, v in rows.items() }, 'peak_rss_mb' : rss_mb() or 0.0 }
+    open_phases.append(record)
+
+    start_time = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start_time
+
+        fold_peak()
+        open_phases.remove(record)
+
+        record['rss_mb'] = rss_mb()
+        run['phases'].append(record)
+
+
+def step(name, **rows):
+
+    #Ends the current step, if any, and starts the next; the last step ends when the run does
+    global current_step
+
+    end_step()
+    if run is None:
+        return {}
+
+    current_step = phase(name, **rows)
+
+    return current_step.__enter__()
+
+
+def end_step():
+
+    global current_step
+
+    if current_step is not None:
+        step, current_step = current_step, None
+        step.__exit__(None, None, None)
+
+
+def rows(name, n):
+
+    #Row count for the innermost open phase, or the run as a whole outside any phase
+    if run is None:
+        return
+
+    (open_phases[-1]['rows'] if open_phases else run['rows'])[name] = int(n)
+
+
+def failure(kind, n = 1):
+
+    #Count of items a script skipped, dropped or could not compute, by kind
+    if run is None or n == 0:
+        return
+
+    run['failures'][kind] = run['failures'].get(kind, 0) + int(n)
+
+
+def finish():
+
+    if run is None or 'finished' in run:
+        return
+
+    end_step()
+    fold_peak()
+
+    if run['status'] == 'running':
+        run['status'] = 'completed'
+    run['finished'] = datetime.now().isoformat(timespec = 'seconds')
+    run['seconds'] = time.perf_counter() - run.pop('start_time')
+    run['children_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    path = os.environ.get('RUN_REPORT') or os.path.join(report_dir, run['script'].split('.')[0] + '_' + datetime.now().strftime('%Y%m%d-%H%M%S') + '_' + str(run['pid']) + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+
+    with open(path, 'w') as f:
+        json.dump(run, f, indent = 2, default = str)
+
+    print('\nRun report written to ' + path)
@@ -0,0 +1,113 @@
+import numpy as np
+
+#Population-weighted nearest neighbours. A k-nearest query against a tree holding every point repeated
+#weight times returns, up to ties, the nearest points whose cumulative weight first reaches k. The same set
+#comes from a plain tree of the points: sort neighbours by distance and cut the weight prefix sum at k.
+
+def prefix_batches(tree, weights, points, targets, budget = 20000000):
+
+    #Yields (rows, idx, dist, counts) per batch: idx/dist are distance-sorted neighbours of points[rows], and
+    #counts[i] is how many of them it takes to reach targets[rows[i]] (-1 when the total weight falls short)
+    weights = np.asarray(weights, dtype = float)
+    targets = np.asarray(targets, dtype = float)
+    n = tree.n
+
+    mean_weight = max(weights.sum() / max(n, 1), 1e-9)
+    total_weight = weights.sum()
+
+    order = np.argsort(targets, kind = 'stable')
+    pending = order[np.isfinite(targets[order])]
+
+    unreachable = order[~np.isfinite(targets[order])]
+    if len(unreachable) > 0:
+        yield unreachable, np.zeros((len(unreachable), 0), dtype = np.int64), np.zeros((len(unreachable), 0)), np.full(len(unreachable), -1)
+
+    while len(pending) > 0:
+        #Size the batch for the largest target in it (targets are sorted), then grow k for rows that fall short
+        rows = pending[:max(1, budget // guess(targets[pending[0]], mean_weight, n))]
+        rows = rows[:max(1, budget // guess(targets[rows[-1]], mean_weight, n))]
+        k = guess(targets[rows[-1]], mean_weight, n)
+
+        while True:
+            dist, idx = tree.query(points[rows], k = k)
+            dist = dist.reshape(len(rows), -1); idx = idx.reshape(len(rows), -1)
+
+            #Equidistant neighbours come back in tree order; order them by index so every tree over the same points
+            #(tiles keep the global order) cuts ties alike
+            order = np.lexsort((idx, dist))
+            dist = np.take_along_axis(dist, order, axis = 1); idx = np.take_along_axis(idx, order, axis = 1)
+
+            cumulative = np.cumsum(weights[idx], axis = 1)
+            reached = cumulative >= targets[rows][:, None]
+            found = reached.any(axis = 1)
+
+            #A cut tied with the farthest neighbour fetched may be missing equidistant points of lower index
+            cut = dist[np.arange(len(rows)), reached.argmax(axis = 1)]
+            open_tie = found & (targets[rows] > 0) & (cut >= dist[:, -1])
+
+            if ((found & ~open_tie) | (~found & (targets[rows] > total_weight))).all() or k >= n:
+                break
+
+            k = min(n, k * 2)
+
+        counts = np.where(found & (targets[rows] > 0), reached.argmax(axis = 1) + 1, -1)
+
+        yield rows, idx, dist, counts
+
+        pending = pending[len(rows):]
+
+
+def guess(target, mean_weight, n):
+
+    return int(max(1, min(n, np.ceil(target / mean_weight * 2) + 16)))
+
+
+def neighborhoods(tree, weights, points, targets, budget = 20000000):
+
+    #Neighbour indices per query point (None where the target could not be reached). Zero-weight points are
+    #left out, as they never appear in the repeated-point tree.
+    weights = np.asarray(weights, dtype = float)
+
+    result = [None] * len(points)
+    for rows, idx, _, counts in prefix_batches(tree, weights, points, targets, budget):
+        for row, i, count in zip(rows, idx, counts):
+            if count > 0:
+                result[row] = i[:count][weights[i[:count]] > 0]
+
+    return result
+
+
+def neighborhood_sums(tree, weights, groups, group_values, points, targets, budget = 20000000):
+
+    #Sums group_values over the distinct groups (e.g. blocks split into several district pieces) that have
+    #at least one point in each neighbourhood. Returns the sums, the radius reached, and which targets were met.
+    weights = np.asarray(weights, dtype = float)
+    group_values = np.asarray(group_values, dtype = float)
+    n_groups = group_values.shape[0]
+    padded_values = np.vstack([group_values, np.zeros((1, group_values.shape[1]))])
+
+    sums = np.zeros((len(points), group_values.shape[1]))
+    radius = np.full(len(points), np.nan)
+    reached = np.zeros(len(points), dtype = bool)
+
+    for rows, idx, dist, counts in prefix_batches(tree, weights, points, targets, budget):
+        if idx.shape[1] == 0:
+            continue
+
+        in_prefix = (np.arange(idx.shape[1])[None, :] < counts[:, None]) & (weights[idx] > 0)
+        codes = np.where(in_prefix, groups[idx], n_groups)
+
+        #Count each group once per neighbourhood
+        codes = np.sort(codes, axis = 1)
+        first = np.ones(codes.shape, dtype = bool)
+        first[:, 1:] = codes[:, 1:] != codes[:, :-1]
+        codes = np.where(first, codes, n_groups)
+
+        for c in range(group_values.shape[1]):
+            sums[rows, c] = padded_values[codes, c].sum(axis = 1)
+
+        ok = counts > 0
+        reached[rows] = ok
+        radius[rows[ok]] = dist[ok, counts[ok] - 1]
+
+    return sums, radius, reached
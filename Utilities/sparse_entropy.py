@@ -0,0 +1,17 @@
+import numpy as np
+
+#Shannon entropy of sparse count matrices, shared by the block UDM (GerrymanderingMetrics/udm.py) and the simulated
+#electorates (Segregation/simulation_metrics.py).
+
+def entropy(counts):
+
+    #Row-wise Shannon entropy (bits) of a sparse (point x district) count matrix; empty rows are 0
+    counts = counts.tocsr()
+    counts.eliminate_zeros()
+
+    totals = np.asarray(counts.sum(axis = 1)).ravel()
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+
+    p = counts.data / totals[rows]
+
+    return -np.bincount(rows, weights = p * np.log2(p), minlength = counts.shape[0])
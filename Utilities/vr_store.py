@@ -0,0 +1,55 @@
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+#Columnar store of cleaned voter registration records: one directory per snapshot, partitioned by county_desc
+
+categoricals = ['party_cd', 'race_code', 'ethnic_code', 'precinct_abbrv']
+
+precinct_keys = ['county_desc', 'precinct_abbrv', 'party_cd', 'race_code', 'ethnic_code']
+
+def pad_precinct(precincts):
+
+    return precincts.astype(str).str.strip().str.zfill(6)
+
+
+def reset_snapshot(store, snapshot):
+
+    path = os.path.join(store, snapshot)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    return path
+
+
+def write_chunk(vr, store, snapshot, part):
+
+    vr = vr.drop(columns = [c for c in ['status_cd', 'reason_cd'] if c in vr.columns])
+    vr['precinct_abbrv'] = pad_precinct(vr['precinct_abbrv'])
+
+    for c in categoricals:
+        vr[c] = vr[c].astype('category')
+
+    table = pa.Table.from_pandas(vr, preserve_index = False)
+    pq.write_to_dataset(table, os.path.join(store, snapshot), partition_cols = ['county_desc'], basename_template = 'part-' + str(part) + '-{i}.parquet')
+
+
+def read_store(path, columns = None, counties = None):
+
+    filters = None if counties is None else [('county_desc', 'in', list(counties))]
+
+    return pd.read_parquet(path, columns = columns, filters = filters)
+
+
+def precinct_counts(path, counties = None):
+
+    #Same layout as the precinct grouping written by 1_group_vr_by_precinct.py
+    vr = read_store(path, columns = precinct_keys, counties = counties)
+    vr = vr.groupby(precinct_keys, observed = True).size().reset_index(name = 'Voters')
+
+    for c in precinct_keys:
+        vr[c] = vr[c].astype(str)
+
+    return vr
@@ -3,6 +3,14 @@ from tqdm import tqdm
 import pandas as pd
 import geopandas as gpd
 import argparse
+import numpy as np
+import shapely
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import areal_weights
+import block_weights
+import geometry_cache
+import instrumentation
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -17,22 +25,29 @@ parser.add_argument('-r', '--reference', type = str, help = '2022 ZCTA shapefile
 parser.add_argument('-b', '--blocks', type = str, help = 'Census block shapefile')
 parser.add_argument('-d', '--demographics', type = str, help = 'Census block popuation data')
 parser.add_argument('-o', '--output', type = str, help = 'Output file name')
+parser.add_argument('-s', '--state', type = str, default = 'NCRawData/sldu_shapefiles/sldu_shapefile_2020-2024.zip', help = 'A shapefile of districts covering the state (dissolved by ST) used to clip both ZCTA layers')
 
 args = parser.parse_args()
 
+instrumentation.start(__file__, args)
+
+instrumentation.step('load')
+
 block_pop = pd.read_csv(args.demographics)[['GISJOIN', 'NL_W', 'NL_B', 'NL_O', 'HL_W', 'HL_B', 'HL_O']]
 block_pop['ALL'] = block_pop['NL_W'] + block_pop['NL_B'] + block_pop['NL_O'] + block_pop['HL_W'] + block_pop['HL_B'] + block_pop['HL_O']
 block_pop = block_pop[['GISJOIN', 'ALL']]
 
-block_shp_raw = gpd.read_file(args.blocks).to_crs('ESRI:102003')
+block_shp_raw = geometry_cache.load(args.blocks)
 block_shp_raw = block_shp_raw[['GISJOIN', 'geometry']]
 
 block_shp = pd.merge(block_shp_raw, block_pop, on = 'GISJOIN')
+instrumentation.rows('blocks', block_shp.shape[0])
+instrumentation.failure('blocks_without_demographics', block_shp_raw.shape[0] - block_shp.shape[0])
 
-nc_state = gpd.read_file('NCRawData/sldu_shapefiles/sldu_shapefile_2020-2024.zip').to_crs('ESRI:102003')[['ST', 'geometry']].dissolve(by = 'ST')
+nc_state = geometry_cache.load(args.state)[['ST', 'geometry']].dissolve(by = 'ST')
 nc_state = nc_state.reset_index()
 
-zctas = gpd.read_file(args.zctas).to_crs('ESRI:102003')
+zctas = geometry_cache.load(args.zctas)
 zctas = zctas.sjoin(nc_state, how = 'inner', predicate = 'intersects')
 
 if 'GISJOIN' not in zctas.columns:
@@ -42,44 +57,33 @@ if 'GISJOIN' not in zctas.columns:
     elif 'seims_code' in zctas.columns:
         zctas['GISJOIN'] = zctas['seims_code']
 
-ref = gpd.read_file(args.reference).to_crs('ESRI:102003')
+ref = geometry_cache.load(args.reference)
 ref = ref.sjoin(nc_state, how = 'inner', predicate = 'intersects')
 
 if 'GISJOIN' not in ref.columns:
     ref['GISJOIN'] = ref['DISTRICT']
 
-overlap_outfile = open('Output/zcta_crosswalk/' + args.output, 'w')
-overlap_outfile.write('ZCTA,Ref,OverlapPop\n')
-
-for _, zcta in tqdm(zctas.iterrows(), total = zctas.shape[0]):
-    for _, ref_unit in ref.iterrows():
-        overlap = zcta.geometry.buffer(0).intersection(ref_unit.geometry.buffer(0))
-        
-        if overlap.area/zcta.geometry.area >= 0.01:
-
-            contained_blocks = block_shp[block_shp.geometry.within(overlap)]
-            overlap_blocks = block_shp[block_shp.geometry.intersects(overlap) & ~block_shp.geometry.within(overlap)]
-
-            overlaps = []
-            for index, block in overlap_blocks.iterrows():
-                try:
-                    overlaps.append(block.geometry.buffer(0).intersection(overlap.buffer(0)).area/block.geometry.area)
-                except Exception as e:
-                    print('\nUnable to count census block ' + block['GISJOIN'] + ' due to: ' + str(e) + '\n')
-                    overlaps.append(0)
-
-            overlap_blocks['overlap'] = overlaps
-            overlap_blocks['overlap'] = overlap_blocks['overlap'].map(lambda x : 0 if x < 0.01 else (1 if x > 0.99 else x))
-            overlap_blocks = overlap_blocks[overlap_blocks['overlap'] > 0]
-            contained_blocks['overlap'] = 1
+instrumentation.rows('zctas', zctas.shape[0])
+instrumentation.rows('reference', ref.shape[0])
+instrumentation.step('overlay')
 
-            contained_blocks = pd.concat([contained_blocks, overlap_blocks])
+#Only (ZCTA, reference) pairs whose geometries intersect can overlap
+zcta_idx, ref_idx = ref.sindex.query(zctas.geometry.values, predicate = 'intersects')
+order = np.lexsort((ref_idx, zcta_idx))
+zcta_idx, ref_idx = zcta_idx[order], ref_idx[order]
 
-            contained_blocks['PW_ALL'] = contained_blocks['ALL'] * contained_blocks['overlap']
+zcta_geoms = np.asarray(zctas.geometry.values); ref_geoms = np.asarray(ref.geometry.values)
+overlaps = shapely.intersection(areal_weights.repair(zcta_geoms, zcta_idx)[zcta_idx], areal_weights.repair(ref_geoms, ref_idx)[ref_idx])
 
-            total_overlap_pop = sum(contained_blocks['PW_ALL'].tolist())
-            
-            overlap_outfile.write(zcta['GISJOIN'] + ',' + ref_unit['GISJOIN'] + ',' + str(total_overlap_pop) + '\n')
+kept = shapely.area(overlaps) / shapely.area(zcta_geoms[zcta_idx]) >= 0.01
+instrumentation.rows('candidate_pairs', len(kept))
+instrumentation.rows('pairs', kept.sum())
+pairs = gpd.GeoDataFrame({ 'ZCTA' : zctas['GISJOIN'].values[zcta_idx[kept]], 'Ref' : ref['GISJOIN'].values[ref_idx[kept]] }, geometry = overlaps[kept], crs = zctas.crs)
 
+#Every block against every kept overlap in one overlay, cached across runs as a sparse (block x pair) matrix
+weights = block_weights.overlap_matrix(block_shp, pairs, block_shp['GISJOIN'], pairs['ZCTA'].astype(str) + '_' + pairs['Ref'].astype(str))
 
+pairs['OverlapPop'] = weights.T @ block_shp['ALL'].to_numpy(dtype = float)
 
+instrumentation.step('write')
+pairs[['ZCTA', 'Ref', 'OverlapPop']].to_csv(os.path.join('Output/zcta_crosswalk', args.output), index = False)